@@ -0,0 +1,114 @@
+import argparse
+import csv
+import json
+import multiprocessing as mp
+import os
+import resource
+import tempfile
+import time
+
+from bench import synthetic
+from bench.servers import FakeServers
+
+
+def run_target(target, work_dir, urls, address):
+    """
+    Runs one process function against the local servers. Executed in a fresh spawned
+    process, so peak RSS only covers this run.
+    """
+    from models import cache, store
+    from networks import etherscan_client, subquery
+    from utils import ratelimit
+
+    os.chdir(work_dir)
+    with open(".env", "w") as f:
+        f.write("ETHERSCAN_KEY=bench\n")
+
+    endpoints = {"subquery": {"url": urls["subquery"]},
+                 "sora-rpc": {"hosts": [urls["rpc"]]},
+                 "etherscan": {"url": urls["etherscan"]}}
+    subquery.configure(endpoints)
+    store.configure(endpoints)
+    etherscan_client.configure(endpoints)
+    cache.configure({"path": os.path.join(work_dir, "assets.json")})
+    # the local servers have no rate limits, measure the code instead of the default Etherscan limit
+    ratelimit.configure({"etherscan": {"rate": 10 ** 6}})
+
+    start = time.perf_counter()
+    if target == "sora":
+        from networks.sora import sora_process
+        sora_process(work_dir, address, 0, 10 ** 9)
+    else:
+        from networks.ethereum import eth_process
+        eth_process(work_dir, address, 0, 99999999)
+    seconds = time.perf_counter() - start
+
+    rows = 0
+    for name in os.listdir(work_dir):
+        if name.endswith(".csv"):
+            with open(os.path.join(work_dir, name), newline="") as f:
+                rows += sum(1 for _ in csv.reader(f)) - 1
+
+    return {"seconds": seconds, "rows": rows, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def benchmark(targets, size, assets, seed):
+    sora_nodes = synthetic.sora_history(size, assets=assets, seed=seed)
+    eth_history = synthetic.eth_history(size, seed=seed)
+    # every tenth asset is unlisted, so assets_getAssetInfo lookups are exercised too
+    listed = [(asset_id, f"Asset {i}", f"A{i}", 18)
+              for i, asset_id in enumerate(synthetic.asset_ids(assets)) if i % 10 != 9]
+
+    results = []
+    ctx = mp.get_context("spawn")
+    with FakeServers(sora_nodes, eth_history, listed) as servers:
+        urls = {"subquery": servers.subquery_url, "etherscan": servers.etherscan_url, "rpc": servers.rpc_url}
+        for target in targets:
+            address = synthetic.sora_address if target == "sora" else synthetic.eth_address
+            requests_before = servers.requests.copy()
+            bytes_before = servers.bytes.copy()
+            with tempfile.TemporaryDirectory() as work_dir, ctx.Pool(1) as pool:
+                result = pool.apply(run_target, (target, work_dir, urls, address))
+
+            result["target"] = target
+            result["size"] = size
+            result["rows_per_sec"] = result["rows"] / result["seconds"] if result["seconds"] > 0 else 0
+            result["requests"] = dict(servers.requests - requests_before)
+            result["bytes"] = dict(servers.bytes - bytes_before)
+            results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end report throughput against local stand-in servers")
+
+    parser.add_argument('--target', action='append', choices=["sora", "ethereum"],
+                        help='process function to benchmark, can be repeated (default: both)')
+    parser.add_argument('--size', type=int, action='append',
+                        help='number of synthetic history elements, can be repeated (default: 1000)')
+    parser.add_argument('--assets', type=int, default=50,
+                        help='number of distinct SORA assets in the synthetic history')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path',
+                        help='also write the results to this file')
+
+    args = parser.parse_args()
+
+    results = []
+    for size in args.size or [1000]:
+        results += benchmark(args.target or ["sora", "ethereum"], size, args.assets, args.seed)
+
+    print(f"{'target':<10}{'size':>9}{'rows':>9}{'seconds':>10}{'rows/sec':>11}{'peak MB':>9}  requests")
+    for result in results:
+        requests = ", ".join(f"{endpoint}={count}" for endpoint, count in sorted(result["requests"].items()))
+        print(f"{result['target']:<10}{result['size']:>9}{result['rows']:>9}{result['seconds']:>10.2f}"
+              f"{result['rows_per_sec']:>11.0f}{result['peak_rss_mb']:>9.1f}  {requests}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
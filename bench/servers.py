@@ -0,0 +1,307 @@
+from aiohttp import web
+from collections import Counter
+from graphql import build_schema, graphql
+import asyncio
+import json
+import threading
+
+schema = build_schema("""
+scalar Cursor
+scalar JSON
+scalar HistoryElementFilter
+
+enum HistoryElementsOrderBy {
+  TIMESTAMP_ASC
+  TIMESTAMP_DESC
+}
+
+type HistoryElement {
+  id: String!
+  timestamp: Int!
+  blockHash: String
+  blockHeight: JSON
+  module: String
+  method: String
+  address: String
+  networkFee: String
+  execution: JSON
+  data: JSON
+}
+
+type HistoryElementsEdge {
+  cursor: Cursor
+  node: HistoryElement
+}
+
+type PageInfo {
+  hasNextPage: Boolean!
+  hasPreviousPage: Boolean!
+  startCursor: Cursor
+  endCursor: Cursor
+}
+
+type HistoryElementsConnection {
+  edges: [HistoryElementsEdge!]!
+  pageInfo: PageInfo!
+  totalCount: Int!
+}
+
+type Metadata {
+  lastProcessedHeight: Int
+}
+
+type Query {
+  _metadata: Metadata
+  historyElements(first: Int, last: Int, before: Cursor, after: Cursor,
+                  orderBy: [HistoryElementsOrderBy!], filter: HistoryElementFilter): HistoryElementsConnection
+}
+""")
+
+
+def json_contains(value, pattern):
+    # jsonb @> semantics
+    if isinstance(pattern, dict):
+        return isinstance(value, dict) and all(k in value and json_contains(value[k], v) for k, v in pattern.items())
+    if isinstance(pattern, list):
+        if not isinstance(value, list):
+            return False
+        return all(any(json_contains(elem, p) for elem in value) for p in pattern)
+    return value == pattern
+
+
+def number(value):
+    return float(value) if isinstance(value, str) else value
+
+
+operators = {
+    "equalTo": lambda value, arg: value == arg,
+    "notEqualTo": lambda value, arg: value != arg,
+    "in": lambda value, arg: value in arg,
+    "greaterThan": lambda value, arg: value is not None and number(value) > number(arg),
+    "lessThan": lambda value, arg: value is not None and number(value) < number(arg),
+    "greaterThanOrEqualTo": lambda value, arg: value is not None and number(value) >= number(arg),
+    "lessThanOrEqualTo": lambda value, arg: value is not None and number(value) <= number(arg),
+    "includesInsensitive": lambda value, arg: value is not None and arg.lower() in value.lower(),
+    "contains": json_contains,
+}
+
+
+def matches(node, flt):
+    """
+    Evaluates a PostGraphile connection filter against a history element.
+    """
+    for key, condition in flt.items():
+        if key == "and":
+            if not all(matches(node, sub) for sub in condition):
+                return False
+        elif key == "or":
+            if not any(matches(node, sub) for sub in condition):
+                return False
+        elif key == "not":
+            if matches(node, condition):
+                return False
+        else:
+            for op, arg in condition.items():
+                if not operators[op](node.get(key), arg):
+                    return False
+    return True
+
+
+class FakeServers:
+    """
+    Local stand-ins for the SubQuery GraphQL endpoint, the Etherscan API and the SORA
+    `assets_*` JSON-RPC methods, served by aiohttp from a background thread.
+    """
+
+    def __init__(self, sora_nodes=(), eth_history=None, assets=(), host="127.0.0.1", port=0,
+                 result_window=10000, page_size=100, head_interval=1.0):
+        self.sora_nodes = list(sora_nodes)
+        # Etherscan action -> entries in descending block order
+        self.eth_history = eth_history or dict()
+        self.assets = list(assets)
+        self.host = host
+        self.port = port
+        self.result_window = result_window
+        self.page_size = page_size
+        # seconds between finalized head notifications
+        self.head_interval = head_interval
+        self.filtered = dict()
+        self.requests = Counter()
+        self.bytes = Counter()
+        self.loop = None
+        self.runner = None
+        self.thread = None
+
+    @property
+    def subquery_url(self):
+        return f"http://{self.host}:{self.port}/graphql"
+
+    @property
+    def etherscan_url(self):
+        return f"http://{self.host}:{self.port}/etherscan"
+
+    @property
+    def rpc_url(self):
+        return f"ws://{self.host}:{self.port}/rpc"
+
+    def start(self):
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def add_history(self, sora_nodes=(), eth_history=None):
+        """
+        Adds newer history, as if new blocks were finalized.
+        """
+        self.sora_nodes[:0] = sora_nodes
+        for action, txs in (eth_history or {}).items():
+            self.eth_history.setdefault(action, [])[:0] = txs
+        self.filtered.clear()
+
+    def sora_head(self):
+        return max((int(node["blockHeight"]) for node in self.sora_nodes), default=0)
+
+    def eth_head(self):
+        return max((int(tx["blockNumber"]) for txs in self.eth_history.values() for tx in txs), default=0)
+
+    def _run(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        app = web.Application()
+        app.router.add_post("/graphql", self._graphql)
+        app.router.add_get("/etherscan", self._etherscan)
+        app.router.add_get("/rpc", self._rpc)
+
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+
+    def _respond(self, endpoint, data):
+        body = json.dumps(data)
+        self.requests[endpoint] += 1
+        self.bytes[endpoint] += len(body)
+        return web.Response(text=body, content_type="application/json")
+
+    def _history_elements(self, info, first=None, last=None, before=None, after=None, orderBy=None, filter=None):
+        # every page of a scan repeats the filter, evaluate it once per scan
+        key = json.dumps([filter, orderBy], sort_keys=True)
+        if key not in self.filtered:
+            if len(self.filtered) > 64:
+                self.filtered.clear()
+            nodes = [node for node in self.sora_nodes if matches(node, filter or {})]
+            if orderBy == ["TIMESTAMP_ASC"]:
+                nodes.reverse()
+            self.filtered[key] = nodes
+        nodes = self.filtered[key]
+
+        start = int(after) if after else 0
+        size = first if first is not None else self.page_size
+        page = nodes[start:start + size]
+        end = start + len(page)
+        return {"edges": [{"cursor": str(start + i + 1), "node": node} for i, node in enumerate(page)],
+                "pageInfo": {"hasNextPage": end < len(nodes), "hasPreviousPage": start > 0,
+                             "startCursor": str(start), "endCursor": str(end)},
+                "totalCount": len(nodes)}
+
+    async def _graphql(self, request):
+        payload = await request.json()
+        result = await graphql(schema, payload["query"], root_value={"historyElements": self._history_elements,
+                                                         "_metadata": {"lastProcessedHeight": self.sora_head()}},
+                               variable_values=payload.get("variables"),
+                               operation_name=payload.get("operationName"))
+        data = {"data": result.data}
+        if result.errors:
+            data["errors"] = [error.formatted for error in result.errors]
+        return self._respond("subquery", data)
+
+    async def _etherscan(self, request):
+        params = request.query
+        if params.get("module") == "proxy" and params.get("action") == "eth_blockNumber":
+            return self._respond("etherscan", {"jsonrpc": "2.0", "id": 83, "result": hex(self.eth_head())})
+
+        if params.get("action") not in ("txlist", "txlistinternal", "tokentx"):
+            return self._respond("etherscan", {"status": "0", "message": "NOTOK", "result": "Unknown action"})
+
+        address = params["address"].lower()
+        start, end = int(params.get("startblock", 0)), int(params.get("endblock", 99999999))
+        txs = [tx for tx in self.eth_history.get(params["action"], [])
+               if address in (tx["from"], tx["to"]) and start <= int(tx["blockNumber"]) <= end]
+        if params.get("sort") == "asc":
+            txs.reverse()
+
+        page, offset = int(params.get("page", 1)), int(params.get("offset", 0))
+        if (offset == 0 and len(txs) > self.result_window) or page * offset > self.result_window:
+            return self._respond("etherscan", {
+                "status": "0", "message": "NOTOK",
+                "result": "Result window is too large, PageNo x Offset size must be less than or equal to 10000"})
+        if offset > 0:
+            txs = txs[(page - 1) * offset:page * offset]
+
+        if len(txs) == 0:
+            return self._respond("etherscan", {"status": "0", "message": "No transactions found", "result": []})
+        return self._respond("etherscan", {"status": "1", "message": "OK", "result": txs})
+
+    def _rpc_result(self, method, params):
+        if method == "assets_listAssetInfos":
+            return [{"asset_id": asset_id, "name": name, "symbol": symbol, "precision": precision}
+                    for asset_id, name, symbol, precision in self.assets]
+        if method == "assets_getAssetInfo":
+            for asset_id, name, symbol, precision in self.assets:
+                if asset_id == params[0]:
+                    return {"asset_id": asset_id, "name": name, "symbol": symbol, "precision": precision}
+            return {"asset_id": params[0], "name": "Registered " + params[0][-4:], "symbol": "R" + params[0][-4:],
+                    "precision": 18}
+        if method == "assets_totalSupply":
+            # the supply grows with the block of the optional block hash
+            at = int(params[1], 16) if len(params) > 1 else 10 ** 6
+            return {"balance": str((int(params[0][-8:], 16) + at) * 10 ** 18)}
+        return None
+
+    async def _send_heads(self, ws, subscription):
+        while not ws.closed:
+            body = json.dumps({"jsonrpc": "2.0", "method": "chain_finalizedHead",
+                               "params": {"subscription": subscription,
+                                          "result": {"number": hex(self.sora_head())}}})
+            self.requests["sora-rpc"] += 1
+            self.bytes["sora-rpc"] += len(body)
+            await ws.send_str(body)
+            await asyncio.sleep(self.head_interval)
+
+    async def _rpc(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        heads = None
+        async for msg in ws:
+            req = json.loads(msg.data)
+            if req["method"] == "chain_subscribeFinalizedHeads":
+                await ws.send_str(json.dumps({"jsonrpc": "2.0", "id": req["id"], "result": "finalized-heads"}))
+                heads = asyncio.ensure_future(self._send_heads(ws, "finalized-heads"))
+                continue
+
+            body = json.dumps({"jsonrpc": "2.0", "id": req["id"], "result": self._rpc_result(req["method"],
+                                                                                              req["params"])})
+            self.requests["sora-rpc"] += 1
+            self.bytes["sora-rpc"] += len(body)
+            await ws.send_str(body)
+
+        if heads is not None:
+            heads.cancel()
+        return ws
@@ -0,0 +1,117 @@
+import random
+
+sora_address = "cnUZkAbtX2u9ko8g6uwihfGNUrXTVEiG2oB4ZTU5VF98eqe43"
+eth_address = "0x5bc0aa9a9d4a1cfb55d2a8d2ab25b1c4f4b2e6b1"
+
+xor = "0x0200000000000000000000000000000000000000000000000000000000000000"
+
+
+def asset_ids(count):
+    return [xor] + ["0x02{:062x}".format(i) for i in range(1, count)]
+
+
+def amount(rng):
+    return "{}.{:06d}".format(rng.randint(0, 10000), rng.randint(0, 999999))
+
+
+def base_units(rng):
+    return str(rng.randint(1, 10 ** 22))
+
+
+def sora_history(size, address=sora_address, assets=50, seed=0):
+    """
+    History elements of `address` in TIMESTAMP_DESC order with a mix of every processed
+    (module, method) pair. Block heights decrease by 1..3 per element.
+    """
+    rng = random.Random(seed)
+    ids = asset_ids(assets)
+    other = "cnRVHmuzxUVU3BFFPcvmxAZZUQEJr2NVc9A2VSPDUniQjZbJm"
+
+    nodes = []
+    height = size * 3 + 1
+    for i in range(size):
+        height -= rng.randint(1, 3)
+        timestamp = 1650000000 + height * 6
+        kind = rng.randrange(10)
+        node = {"id": "0x{:064x}".format(i), "timestamp": timestamp, "blockHash": "0x{:064x}".format(height),
+                "blockHeight": str(height), "address": address, "networkFee": "0.0007",
+                "execution": {"success": rng.random() > 0.02}}
+
+        if kind < 3:
+            incoming = rng.random() < 0.5
+            node.update(module="assets", method="transfer",
+                        address=other if incoming else address,
+                        data={"from": other if incoming else address, "to": address if incoming else other,
+                              "amount": amount(rng), "assetId": rng.choice(ids)})
+        elif kind < 6:
+            node.update(module="liquidityProxy", method="swap",
+                        data={"baseAssetId": rng.choice(ids), "targetAssetId": rng.choice(ids),
+                              "baseAssetAmount": amount(rng), "targetAssetAmount": amount(rng),
+                              "liquidityProviderFee": amount(rng), "selectedMarket": "SMART"})
+        elif kind < 7:
+            node.update(module="poolXYK", method=rng.choice(["depositLiquidity", "withdrawLiquidity"]),
+                        data={"baseAssetId": xor, "targetAssetId": rng.choice(ids),
+                              "baseAssetAmount": amount(rng), "targetAssetAmount": amount(rng)})
+        elif kind < 8:
+            node.update(module="rewards", method="claim",
+                        data=[{"assetId": rng.choice(ids), "amount": base_units(rng)}
+                              for _ in range(rng.randint(1, 3))])
+        elif kind < 9:
+            node.update(module="ethBridge", method="transferToSidechain",
+                        data={"assetId": rng.choice(ids), "amount": amount(rng),
+                              "sidechainAddress": eth_address})
+        else:
+            node.update(module="assets", method="register",
+                        data={"assetId": "0x03{:062x}".format(i)})
+
+        nodes.append(node)
+
+    return nodes
+
+
+def eth_history(size, address=eth_address, seed=0):
+    """
+    Etherscan txlist, txlistinternal and tokentx results of `address` for `size` transactions,
+    in descending block order: token transfers sent and received, ETH transfers, swaps refunding
+    ETH through an internal transaction and plain contract calls, some of them failed.
+    """
+    rng = random.Random(seed)
+    other = "0x8ba1f109551bd432803012645ac136ddd64dba72"
+    router = "0x7a250d5630b4cf539739df2c5dacb4c659f2488d"
+    tokens = [("DAI", 18), ("USDT", 6), ("XOR", 18), ("VAL", 18), ("PSWAP", 18)]
+    history = {"txlist": [], "txlistinternal": [], "tokentx": []}
+
+    height = size * 3 + 1
+    for i in range(size):
+        height -= rng.randint(1, 3)
+        kind = rng.randrange(10)
+        tx = {"blockNumber": str(height), "timeStamp": str(1500000000 + height * 13), "hash": "0x{:064x}".format(i),
+              "from": address, "to": other, "value": "0", "gas": "60000", "gasUsed": str(rng.randint(21000, 60000)),
+              "gasPrice": str(rng.randint(10, 100) * 10 ** 9), "isError": "0", "functionName": ""}
+        symbol, decimals = rng.choice(tokens)
+        transfer = {**tx, "value": base_units(rng), "tokenName": symbol, "tokenSymbol": symbol,
+                    "tokenDecimal": str(decimals), "contractAddress": "0x{:040x}".format(decimals)}
+
+        if kind < 4:
+            history["txlist"].append({**tx, "to": transfer["contractAddress"],
+                                      "functionName": "transfer(address _to, uint256 _value)"})
+            history["tokentx"].append(transfer)
+        elif kind < 6:
+            history["tokentx"].append({**transfer, "from": other, "to": address})
+        elif kind < 7:
+            history["txlist"].append({**tx, "value": base_units(rng)})
+        elif kind < 8:
+            history["txlist"].append({**tx, "from": other, "to": address, "value": base_units(rng)})
+        elif kind < 9:
+            history["txlist"].append({**tx, "to": router, "value": "0",
+                                      "functionName": "swapExactTokensForETH(uint256 amountIn)"})
+            history["tokentx"].append({**transfer, "to": router})
+            history["txlistinternal"].append({"blockNumber": tx["blockNumber"], "timeStamp": tx["timeStamp"],
+                                              "hash": tx["hash"], "from": router, "to": address,
+                                              "value": base_units(rng), "type": "call", "isError": "0"})
+        else:
+            history["txlist"].append({**tx, "to": transfer["contractAddress"],
+                                      "isError": "1" if rng.random() < 0.2 else "0",
+                                      "functionName": "approve(address spender, uint256 amount)"})
+
+    return history
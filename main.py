@@ -1,22 +1,50 @@
+import asyncio
 import json
-import multiprocessing as mp
 import os
 import argparse
+import sys
 
+from models import cache, db, report, store
 from networks.ethereum import eth_process
-from networks.sora import sora_process
+from networks.sora import sora_process, sora_process_many
+from networks import etherscan_client, sora, subquery, watch
+from utils import http_cache, metrics, ratelimit, scheduler
+from utils.scheduler import Job, Scheduler
 
 function_mappings = {
     "sora": sora_process,
     "ethereum": eth_process
 }
 
+default_to_block = {
+    "sora": 1000,
+    "ethereum": 99999999
+}
+
+
+def configure(config):
+    subquery.configure(config.get("endpoints", {}))
+    etherscan_client.configure(config.get("endpoints", {}))
+    store.configure(config.get("endpoints", {}))
+    cache.configure(config.get("asset-cache", {}))
+    db.configure(config.get("store", {}))
+    http_cache.configure(config.get("http-cache", {}))
+    report.configure(config.get("report", {}))
+    ratelimit.configure(config.get("endpoints", {}))
+    scheduler.configure(config.get("scheduler", {}))
+    sora.configure(config.get("scheduler", {}))
+    watch.configure(config.get("watch", {}))
+
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('config_path',
                         help='config file with networks data')
+    parser.add_argument('--profile', action='store_true',
+                        help='write per job stage timings and counters to profile.json and profile.prom')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and append the rows of every new finalized block to the reports')
 
     args = parser.parse_args()
 
@@ -24,10 +52,14 @@ def main():
 
     data = json.load(f)
 
-    pool = mp.Pool(mp.cpu_count() + 2)
+    configure(data)
 
     cwd = os.getcwd()
 
+    # sora entries scanned together when "batch-addresses" is set: (from, to, incremental) -> addresses
+    sora_groups = dict()
+
+    # (network, job) pairs, the network tells which chain head a job follows in watch mode
     jobs = []
     for elem in data["networks"]:
         p = function_mappings.get(elem["name"], None)
@@ -50,16 +82,44 @@ def main():
             elem["from-block"] = 0
 
         if "to-block" not in elem:
-            elem["to-block"] = 1000
-
-        job = pool.apply_async(p, (cwd, elem["address"], elem["from-block"], elem["to-block"]))
-        jobs.append(job)
-
-    for job in jobs:
-        job.get()
-
-    pool.close()
-    pool.join()
+            elem["to-block"] = default_to_block[elem["name"]]
+
+        job_args = (cwd, elem["address"], elem["from-block"], elem["to-block"], elem.get("incremental", False))
+        if elem["name"] == "sora":
+            # transaction types to fetch, all of them by default
+            types = elem.get("types")
+            if data.get("batch-addresses", False):
+                key = (elem["from-block"], elem["to-block"], elem.get("incremental", False),
+                       None if types is None else tuple(types))
+                sora_groups.setdefault(key, []).append(elem["address"])
+                continue
+            job_args += (types,)
+
+        jobs.append((elem["name"], Job("{} {}".format(elem["name"], elem["address"]), p, job_args)))
+
+    for (from_block, to_block, incremental, types), addresses in sora_groups.items():
+        jobs.append(("sora", Job("sora {} addresses".format(len(addresses)), sora_process_many,
+                                 (cwd, addresses, from_block, to_block, incremental, types))))
+
+    if args.watch:
+        report.settings["append"] = True
+        try:
+            asyncio.run(watch.watch(jobs))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    jobs = [job for _, job in jobs]
+    failed = asyncio.run(Scheduler(jobs, profile=args.profile).run())
+
+    if args.profile:
+        profiled = [job.metrics for job in jobs if job.metrics is not None]
+        metrics.write_summary(os.path.join(cwd, "profile.json"), profiled)
+        metrics.write_prometheus(os.path.join(cwd, "profile.prom"), profiled)
+        print("Profile written to profile.json and profile.prom")
+
+    if len(failed) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+from models.token import Token
+from utils.files import write_json
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+settings = {
+    "path": os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "sorascan", "assets.json"),
+    # seconds before the full asset list is downloaded again
+    "ttl": 24 * 60 * 60,
+    # total supply lookups memoized by each TokenStore, older ones are read back from the supply table
+    "supply-lru-size": 4096,
+}
+
+
+def configure(options: dict):
+    settings.update(options)
+
+
+class SupplyCache:
+    """
+    (asset id, block hash) -> total supply in base units, in a SQLite table that is read one key
+    at a time. A supply at a past block never changes and does not expire.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS supplies (asset_id TEXT NOT NULL, "
+                                        "block_hash TEXT NOT NULL, balance TEXT NOT NULL, "
+                                        "PRIMARY KEY (asset_id, block_hash))")
+        except (OSError, sqlite3.Error) as e:
+            print("WARN: Cannot open supply cache {}: {}".format(path, e))
+            self.connection = None
+
+    def get(self, key):
+        if self.connection is None:
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT balance FROM supplies WHERE asset_id = ? AND block_hash = ?",
+                                          key).fetchone()
+        return int(row[0]) if row is not None else None
+
+    def update(self, supplies: dict):
+        if self.connection is None:
+            return
+        # balances exceed the SQLite integer range
+        rows = [(asset_id, block_hash, str(balance)) for (asset_id, block_hash), balance in supplies.items()]
+        try:
+            with self.lock, self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO supplies VALUES (?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            print("WARN: Cannot save supply cache {}: {}".format(self.path, e))
+
+
+class AssetCache:
+    """
+    On-disk cache of asset id -> Token shared between runs. `synced` is the time of the
+    last full `assets_listAssetInfos` download, assets fetched one by one are added in between.
+    `supplies` is the SupplyCache in `supplies.db` next to it.
+    """
+
+    def __init__(self, path=None, ttl=None):
+        self.path = os.path.expanduser(path or settings["path"])
+        self.ttl = settings["ttl"] if ttl is None else ttl
+        self.synced = 0
+        self.tokens = dict()
+        self.supplies = SupplyCache(os.path.join(os.path.dirname(self.path), "supplies.db"))
+        # updates from the threads of a shared TokenStore are saved one at a time
+        self.lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        self.synced = data.get("synced", 0)
+        for asset_id, (name, ticker, precision) in data.get("assets", {}).items():
+            self.tokens[asset_id] = Token(name, ticker, int(precision))
+        # kept in the file by earlier versions, they are dropped from it on the next save
+        supplies = dict()
+        for key, balance in data.get("supplies", {}).items():
+            asset_id, block_hash = key.split("@")
+            supplies[(asset_id, block_hash)] = int(balance)
+        self.supplies.update(supplies)
+
+    def is_fresh(self):
+        return len(self.tokens) > 0 and time.time() - self.synced < self.ttl
+
+    def update(self, tokens: dict, synced=False):
+        with self.lock:
+            self.tokens.update(tokens)
+            if synced:
+                self.synced = time.time()
+            self.save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        data = {"synced": self.synced,
+                "assets": {asset_id: [token.name, token.ticker, token.precision]
+                           for asset_id, token in self.tokens.items()}}
+
+        try:
+            write_json(self.path, data)
+        except OSError as e:
+            print("WARN: Cannot save asset cache {}: {}".format(self.path, e))
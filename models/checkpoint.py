@@ -0,0 +1,87 @@
+from utils.files import write_json
+
+import json
+import os
+
+
+class Checkpoint:
+    """
+    Highest processed block of an (network, address) report, kept next to the reports so the
+    next run only fetches newer blocks. A checkpoint only applies to runs with the same
+    from-block and transaction types (a sorted list, None for all of them) it was created with.
+    The report is None when the scanned blocks had no rows.
+
+    It also records the partial report a failed run left behind, which the next run scanning
+    from the same block continues instead of fetching its blocks again.
+    """
+
+    def __init__(self, base_path, network, address, from_block, types=None):
+        self.path = os.path.join(base_path, ".sorascan", "checkpoints", f"{network}-{address}.json")
+        self.from_block = from_block
+        self.types = types
+        self.block = None
+        self.report = None
+        self.partial = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        # a report of other blocks or types, or none at all, has to be fetched again
+        if data.get("from-block") != self.from_block or data.get("types") != self.types:
+            return
+        partial = data.get("partial")
+        if partial is not None and os.path.exists(partial["report"]):
+            self.partial = partial
+        if data["report"] is not None and not os.path.exists(data["report"]):
+            return
+
+        self.block = data["block"]
+        self.report = data["report"]
+
+    def _write(self):
+        write_json(self.path, {"from-block": self.from_block, "types": self.types, "block": self.block,
+                               "report": self.report, "partial": self.partial})
+
+    def _drop_partial(self, keep=None):
+        if self.partial is not None and self.partial["report"] != keep and os.path.exists(self.partial["report"]):
+            os.remove(self.partial["report"])
+        self.partial = None
+
+    def resume(self, start_block, last_block):
+        """
+        The partial report of a failed scan from start_block, if a scan up to last_block covers it.
+        """
+        partial = self.partial
+        if partial is None or partial["start-block"] != start_block or partial["to-block"] > last_block:
+            return None
+        return partial
+
+    def save(self, block, report):
+        self.block = int(block)
+        self.report = report
+        self._drop_partial()
+        self._write()
+
+    def save_partial(self, partial, start_block, to_block):
+        """
+        Records the (path, block, first) partial report of ReportWriter.abort, from a scan of
+        start_block up to to_block.
+        """
+        path, block, first = partial
+        self._drop_partial(keep=path)
+        self.partial = {"report": path, "start-block": int(start_block), "block": block, "to-block": int(to_block),
+                        "first": first}
+        self._write()
+
+    def clear_partial(self):
+        """
+        Drops the partial report after a finished scan.
+        """
+        if self.partial is not None:
+            self._drop_partial()
+            self._write()
@@ -0,0 +1,108 @@
+from models.report import amount_columns, columns, output_values
+from utils import metrics
+from utils.batch import RowBatch
+from utils.precision import Amount
+
+import os
+import sqlite3
+
+settings = {
+    # path of the SQLite database, the local store is disabled when it is not set
+    "path": None,
+}
+
+
+def configure(options: dict):
+    settings.update(options)
+
+
+def open_store(network, address):
+    if settings["path"] is None:
+        return None
+    return TransactionDB(os.path.expanduser(settings["path"]), network, address)
+
+
+class TransactionDB:
+    """
+    Local SQLite store of normalized rows, indexed by network (`chain`), address (`account`),
+    block height and transaction type. Rows are keyed by (chain, account, tx_hash, line), so
+    re-processing a range replaces the rows instead of duplicating them.
+    """
+
+    def __init__(self, path, network=None, address=None):
+        self.network = network
+        self.address = address
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self._create()
+
+    def _create(self):
+        fields = ", ".join(f"{column} TEXT" for column in columns if column not in ("height", "line"))
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS transactions ("
+                                    f"chain TEXT NOT NULL, account TEXT NOT NULL, "
+                                    f"height INTEGER NOT NULL, line INTEGER NOT NULL, {fields}, "
+                                    f"PRIMARY KEY (chain, account, tx_hash, line))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS transactions_height "
+                                    "ON transactions (chain, account, height)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS transactions_type "
+                                    "ON transactions (chain, account, type, height)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, batch: RowBatch):
+        if not batch:
+            return
+
+        names = ["chain", "account"] + batch.columns
+        placeholders = ", ".join("?" * len(names))
+        data = output_values(batch)
+        data["height"] = [int(height) for height in data["height"]]
+        values = [data[column] for column in batch.columns]
+        rows = zip([self.network] * len(batch), [self.address] * len(batch), *values)
+
+        with metrics.timer("store.write"), self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO transactions ({', '.join(names)}) "
+                                        f"VALUES ({placeholders})", rows)
+
+    def query(self, network, address, from_block=None, to_block=None, types=None, page_size=10000):
+        """
+        Yields RowBatch pages of the stored rows in report order: newest block first.
+        from_block is exclusive and to_block is inclusive, as in report names. Amounts are
+        stored as decimal strings and returned as Amounts, like the rows of a live scan.
+        """
+        conditions = ["chain = ?", "account = ?"]
+        params = [network, address]
+        if from_block is not None:
+            conditions.append("height > ?")
+            params.append(from_block)
+        if to_block is not None:
+            conditions.append("height <= ?")
+            params.append(to_block)
+        if types:
+            conditions.append(f"type IN ({', '.join('?' * len(types))})")
+            params.extend(types)
+
+        cursor = self.connection.execute(f"SELECT {', '.join(columns)} FROM transactions "
+                                         f"WHERE {' AND '.join(conditions)} "
+                                         f"ORDER BY height DESC, timestamp DESC, tx_hash, line", params)
+        batch = RowBatch(columns)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if len(rows) == 0:
+                return
+
+            values = dict(zip(batch.columns, zip(*rows)))
+            for column in amount_columns:
+                values[column] = [Amount.parse(value) for value in values[column]]
+
+            batch.clear()
+            batch.extend_columns(values)
+            yield batch
+
+    def close(self):
+        self.connection.close()
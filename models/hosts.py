@@ -0,0 +1,54 @@
+from collections import deque
+import statistics
+import time
+
+
+class Host:
+    """
+    Latency and health statistics of one RPC endpoint.
+    """
+
+    def __init__(self, url: str, window=100):
+        self.url = url
+        self.latencies = deque(maxlen=window)
+        self.failures = 0
+        self.down_until = 0
+
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def latency(self):
+        # hosts without samples go first, so every host gets measured
+        if len(self.latencies) == 0:
+            return 0
+        return statistics.median(self.latencies)
+
+    def p95(self):
+        if len(self.latencies) < 10:
+            return None
+        return statistics.quantiles(self.latencies, n=20)[-1]
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.failures = 0
+        self.down_until = 0
+
+    def fail(self):
+        self.failures += 1
+        self.down_until = time.monotonic() + min(2 ** self.failures, 60)
+
+
+class HostPool:
+    def __init__(self, urls):
+        self.hosts = [Host(url) for url in urls]
+
+    def ranked(self):
+        """
+        Healthy hosts from the fastest to the slowest, then the unhealthy ones
+        in the order they are due to come back.
+        """
+        healthy = [host for host in self.hosts if host.healthy()]
+        unhealthy = [host for host in self.hosts if not host.healthy()]
+        healthy.sort(key=lambda host: host.latency())
+        unhealthy.sort(key=lambda host: host.down_until)
+        return healthy + unhealthy
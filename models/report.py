@@ -0,0 +1,473 @@
+from datetime import datetime
+from decimal import Decimal
+import csv
+import json
+import pandas as pd
+from utils import metrics
+from utils.batch import RowBatch
+from utils.precision import Amount, format_amounts
+import os
+import secrets
+import shutil
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+settings = {
+    # csv, parquet, arrow or jsonl
+    "format": "csv",
+    # parquet and arrow compression codec, None to disable
+    "compression": "zstd",
+    # append the rows of newer blocks to the end of the previous csv or jsonl report, or add
+    # them as a part file to a parquet or arrow report directory, instead of rewriting it with
+    # the new rows first, set by the watch mode
+    "append": False,
+}
+
+columns = {"scan": "Scan Tool", "network": "Data Source", "timestamp": "Time Stamp", "date": "Date and Time (UTC)",
+           "height": "Block height", "tx_hash": "Transaction hash", "line": "Line Number",
+           "type": "Transaction Type", "amount": "Token amount", "ticker": "Token ticker",
+           "send_or_receive": "Sender or Receiver", "sender": "Sending wallet",
+           "receiver": "Receiving side address",
+           "network_fee": "Network fee amount", "fee_ticker": "Network fee token ticker",
+           "lp_fee": "Liquidity Provider Fee",
+           "lp_fee_ticker": "Liquidity Provider Fee token ticker"}
+
+amount_columns = ("amount", "network_fee", "lp_fee")
+integer_columns = ("timestamp", "height", "line")
+
+
+def output_values(batch: RowBatch):
+    """
+    Column values of batch as written to the outputs, with amounts converted to decimal strings.
+    """
+    return {column: format_amounts(values) if column in amount_columns else values
+            for column, values in batch.data.items()}
+
+
+def _create_temp(directory, prefix, suffix):
+    """
+    Creates a file under an unpredictable name like mkstemp, but with the usual permissions
+    (0666 less the umask) instead of 0600, as the file becomes the report. Returns (fd, path).
+    """
+    while True:
+        path = os.path.join(directory, f"{prefix}{secrets.token_hex(4)}{suffix}")
+        try:
+            return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), path
+        except FileExistsError:
+            continue
+
+
+def report_files(path):
+    """
+    The files of the report at path, newest rows first: the report itself, or the parts of a
+    report directory.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return [os.path.join(path, name) for name in sorted(os.listdir(path), reverse=True)]
+
+
+def remove_report(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def arrow_schema():
+    """
+    Typed schema of the columnar outputs: integers, UTC dates and exact decimal amounts.
+    """
+    fields = []
+    for column in columns:
+        if column in integer_columns:
+            fields.append(pa.field(column, pa.int64()))
+        elif column == "date":
+            fields.append(pa.field(column, pa.timestamp("s", tz="UTC")))
+        elif column in amount_columns:
+            fields.append(pa.field(column, pa.decimal128(38, 18)))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+def _decimal(value):
+    if not isinstance(value, Amount):
+        return None
+    if value.precision > 18:
+        # the amount columns have 18 decimals
+        whole, rest = divmod(value.value, 10 ** (value.precision - 18))
+        if rest != 0:
+            print("WARN: {} has more than 18 decimals, it is rounded down to {}".format(value, Amount(whole, 18)))
+        value = Amount(whole, 18)
+    return Decimal(value.value).scaleb(-value.precision)
+
+
+def arrow_batch(batch: RowBatch, schema):
+    arrays = []
+    for column in schema.names:
+        values = batch.data[column]
+        if column in integer_columns:
+            arrays.append(pa.array([None if value == "" else int(value) for value in values], pa.int64()))
+        elif column == "date":
+            timestamps = [int(value) for value in batch.data["timestamp"]]
+            arrays.append(pa.array(timestamps, pa.int64()).cast(schema.field(column).type))
+        elif column in amount_columns:
+            arrays.append(pa.array([_decimal(value) for value in values], pa.decimal128(38, 18)))
+        else:
+            arrays.append(pa.array([None if value == "" else str(value) for value in values], pa.string()))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class CsvSink:
+    """
+    The original report format: display column names, amounts as decimal strings and the row
+    number as the first column.
+    """
+
+    extension = "csv"
+
+    @staticmethod
+    def count(path):
+        """
+        Rows of the report at path, from the number of its last row.
+        """
+        with open(path, "rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            size = min(end, 4096)
+            while True:
+                f.seek(end - size)
+                lines = f.read(size).splitlines()
+                if len(lines) > 2 or size == end:
+                    break
+                size = min(end, size * 2)
+        last = next(csv.reader([lines[-1].decode()]), [""]) if len(lines) > 1 else [""]
+        return int(last[0]) + 1 if last[0].isdigit() else 0
+
+    def __init__(self, fd):
+        self.file = os.fdopen(fd, "w", newline="")
+
+    def write(self, batch: RowBatch, rows):
+        frame = pd.DataFrame(output_values(batch), columns=batch.columns).rename(columns=columns)
+        frame.index += rows
+        frame.to_csv(self.file, header=rows == 0)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def copy(self, path, rows):
+        writer = csv.writer(self.file, lineterminator=os.linesep)
+        copied = 0
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if rows == 0 and header is not None:
+                writer.writerow(header)
+            for row in reader:
+                row[0] = rows + copied
+                writer.writerow(row)
+                copied += 1
+        return copied
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesSink:
+    """
+    One JSON object per row keyed by the column names, with integer heights and timestamps and
+    amounts as exact decimal strings.
+    """
+
+    extension = "jsonl"
+
+    @staticmethod
+    def count(path):
+        # rows are only numbered in csv
+        return 0
+
+    def __init__(self, fd):
+        self.file = os.fdopen(fd, "w")
+
+    def write(self, batch: RowBatch, rows):
+        values = output_values(batch)
+        for column in integer_columns:
+            values[column] = [None if value == "" else int(value) for value in values[column]]
+
+        names = batch.columns
+        for row in zip(*(values[column] for column in names)):
+            self.file.write(json.dumps(dict(zip(names, row))))
+            self.file.write("\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def copy(self, path, rows):
+        copied = 0
+        with open(path) as f:
+            for line in f:
+                self.file.write(line)
+                copied += 1
+        return copied
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """
+    Parquet file with the typed schema, every page is written as a row group.
+    """
+
+    extension = "parquet"
+
+    def __init__(self, fd):
+        self.schema = arrow_schema()
+        self.file = os.fdopen(fd, "wb")
+        self.writer = pq.ParquetWriter(self.file, self.schema, compression=settings["compression"] or "none")
+
+    def write(self, batch: RowBatch, rows):
+        self.writer.write_batch(arrow_batch(batch, self.schema))
+
+    def copy(self, path, rows):
+        copied = 0
+        for part in report_files(path):
+            for previous in pq.ParquetFile(part).iter_batches():
+                # parquet has no second resolution timestamps, dates are read back in milliseconds
+                self.writer.write_table(pa.Table.from_batches([previous]).cast(self.schema))
+                copied += previous.num_rows
+        return copied
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
+
+
+class ArrowSink:
+    """
+    Arrow IPC file with the typed schema, every page is written as a record batch.
+    """
+
+    extension = "arrow"
+
+    def __init__(self, fd):
+        self.schema = arrow_schema()
+        self.file = os.fdopen(fd, "wb")
+        options = pa.ipc.IpcWriteOptions(compression=settings["compression"])
+        self.writer = pa.ipc.new_file(self.file, self.schema, options=options)
+
+    def write(self, batch: RowBatch, rows):
+        self.writer.write_batch(arrow_batch(batch, self.schema))
+
+    def copy(self, path, rows):
+        copied = 0
+        for part in report_files(path):
+            with pa.ipc.open_file(part) as reader:
+                for i in range(reader.num_record_batches):
+                    previous = reader.get_batch(i)
+                    self.writer.write_batch(previous)
+                    copied += previous.num_rows
+        return copied
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
+
+
+sinks = {"csv": CsvSink, "parquet": ParquetSink, "arrow": ArrowSink, "jsonl": JsonLinesSink}
+
+
+def configure(options: dict):
+    settings.update(options)
+    if settings["format"] not in sinks:
+        raise ValueError(f"Unknown report format {settings['format']}, expected one of {', '.join(sinks)}")
+    if settings["format"] in ("parquet", "arrow") and pa is None:
+        raise ImportError(f"The {settings['format']} report format needs pyarrow, install it with pip install pyarrow")
+
+
+class ReportWriter:
+    """
+    Streams report pages to a temporary file in base_path and atomically renames it to the
+    final `Network Time Date Address (from:to]` name on close.
+
+    When `previous` is given, the new rows are written first and the rows of the previous
+    report (older blocks) are copied after them, so the result covers both ranges.
+    Rows are written by the sink of `format`, the configured one by default.
+
+    The rows of the lowest block seen so far are held back until a lower block arrives, so the
+    temporary file only ever has complete blocks. abort(keep=True) closes it as a partial report
+    of the blocks above the held one, which a retry passes back as `partial` (the dict recorded
+    by Checkpoint.save_partial): its rows replace the rows of the blocks it covers and the
+    partial file is removed once they are copied into a finished report.
+
+    With the `append` setting, csv and jsonl rows are instead appended to the end of the previous
+    report in place, which is then renamed. Nothing is copied, so following the chain costs the
+    size of the new rows only. A failed write truncates the report back to its previous end.
+    Parquet and arrow files cannot grow, their previous report becomes a directory of part files
+    in block order and the new rows are added to it as the next part.
+    """
+
+    def __init__(self, base_path, network, address, from_block, previous=None, format=None, partial=None):
+        self.base_path = base_path
+        self.network = network
+        self.address = address
+        self.from_block = from_block
+        self.previous = previous
+        self.path = None
+        self.to_block = None
+        self.rows = 0
+        # number of the first new row
+        self.offset = 0
+        # rows of the lowest block, which may continue in the next batch
+        self.held = None
+        # set while the sink writes, the file may end in a broken row
+        self.broken = False
+        sink = sinks[format or settings["format"]]
+        if previous is not None and not previous.endswith(f".{sink.extension}"):
+            raise ValueError(f"Cannot merge {previous} into a {sink.extension} report")
+
+        # only the text sinks can grow in place, they count the rows of an existing report
+        self.appending = settings["append"] and previous is not None and hasattr(sink, "count")
+        # the columnar sinks add a part to the previous report instead
+        self.parts = settings["append"] and previous is not None and not self.appending
+        if partial is not None and (self.appending or not partial["report"].endswith(f".{sink.extension}.part")):
+            partial = None
+        self.partial = partial
+        self.resumed = False
+        if self.appending:
+            self.offset = sink.count(previous)
+            fd = os.open(previous, os.O_WRONLY | os.O_APPEND)
+            self.end = os.lseek(fd, 0, os.SEEK_END)
+            self.temp_path = previous
+        else:
+            fd, self.temp_path = _create_temp(base_path, f".{network} {address} ({from_block}:",
+                                              f".{sink.extension}.part")
+        self.sink = sink(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, batch: RowBatch):
+        if not batch:
+            return
+        if self.partial is None or self.resumed:
+            self._hold(batch)
+            return
+
+        # rows of the blocks in the partial report were written before, they are copied from it
+        heights = [int(height) for height in batch.data["height"]]
+        above = sum(1 for height in heights if height > self.partial["to-block"])
+        below = next((i for i, height in enumerate(heights) if height <= self.partial["block"]), len(heights))
+        self._hold(batch.slice(0, above))
+        if below < len(heights):
+            self._resume()
+            self._hold(batch.slice(below))
+
+    def _hold(self, batch: RowBatch):
+        if not batch:
+            return
+        if self.to_block is None:
+            self.to_block = batch.first("height")
+        if self.held is not None:
+            self.held.extend_columns(batch.data)
+            batch = self.held
+
+        lowest = int(batch.last("height"))
+        split = len(batch)
+        while split > 0 and int(batch.data["height"][split - 1]) == lowest:
+            split -= 1
+        self._write(batch.slice(0, split))
+        self.held = batch.slice(split)
+
+    def _write(self, batch: RowBatch):
+        if not batch:
+            return
+        self.broken = True
+        with metrics.timer("report.write"):
+            self.sink.write(batch, self.offset + self.rows)
+        self.broken = False
+        metrics.count("rows", len(batch))
+        self.rows += len(batch)
+
+    def _flush(self):
+        if self.held is not None:
+            held, self.held = self.held, None
+            self._write(held)
+
+    def _resume(self):
+        self._flush()
+        if self.to_block is None:
+            self.to_block = self.partial["first"]
+        self.broken = True
+        with metrics.timer("report.write"):
+            self.rows += self.sink.copy(self.partial["report"], self.offset + self.rows)
+        self.broken = False
+        self.resumed = True
+
+    def abort(self, keep=False):
+        """
+        Closes the report of a failed run. With keep, returns (path, block, first) of the partial
+        report that holds the complete blocks above block, first being its highest one, or None
+        when there is nothing new to resume: the file is removed and a partial report passed in
+        stays valid.
+        """
+        self.sink.close()
+        if self.appending:
+            os.truncate(self.previous, self.end)
+            return None
+
+        # a partial report that was not copied yet has the blocks below the new rows
+        pending = self.partial is not None and not self.resumed
+        if not keep or self.broken or self.rows == 0 or self.held is None or pending:
+            os.remove(self.temp_path)
+            return None
+        if self.resumed:
+            os.remove(self.partial["report"])
+        return self.temp_path, int(self.held.first("height")), int(self.to_block)
+
+    def _add_part(self, filepath):
+        if os.path.isdir(self.previous):
+            os.replace(self.previous, filepath)
+        else:
+            # a report written in one piece is the first part
+            os.mkdir(filepath)
+            os.replace(self.previous, os.path.join(filepath, f"part-{0:06}.{self.sink.extension}"))
+        part = len(os.listdir(filepath))
+        os.replace(self.temp_path, os.path.join(filepath, f"part-{part:06}.{self.sink.extension}"))
+
+    def close(self):
+        self._flush()
+        if self.partial is not None and not self.resumed:
+            self._resume()
+        if self.rows > 0 and self.previous is not None and not self.appending and not self.parts:
+            self.rows += self.sink.copy(self.previous, self.rows)
+        self.sink.close()
+
+        if self.rows == 0:
+            if not self.appending:
+                os.remove(self.temp_path)
+            self.path = self.previous
+            return self.path
+
+        stime = datetime.now().strftime("%H:%M %d.%m.%y")
+        name = f"{self.network} {stime} {self.address[:4]}...{self.address[-4:]} ({self.from_block}:{self.to_block}]"
+        filepath = os.path.join(self.base_path, f"{name}.{self.sink.extension}")
+        if self.parts:
+            self._add_part(filepath)
+        else:
+            os.replace(self.temp_path, filepath)
+        if self.previous is not None and self.previous != filepath and not self.appending and not self.parts:
+            remove_report(self.previous)
+        if self.resumed:
+            os.remove(self.partial["report"])
+
+        self.path = filepath
+        return filepath
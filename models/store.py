@@ -1,28 +1,96 @@
+from models import cache
+from models.cache import AssetCache
+from models.hosts import HostPool
 from models.token import Token
-from utils.precision import set_precision
+from utils import metrics
+from utils.precision import Amount
+from utils.ratelimit import limit
+from utils.singleflight import SingleFlight
 
+from collections import OrderedDict
+import itertools
 import json
+import select
+import threading
+import time
 import websocket
 from websocket import create_connection
 
+settings = {
+    "hosts": ["wss://sora.api.onfinality.io/public-ws",
+              "wss://ws.mof.sora.org/",
+              "wss://mof2.sora.org/",
+              "wss://mof3.sora.org/"],
+    # seconds to wait for a connection or a response
+    "timeout": 10,
+    # resend a request to the next host when the first one is slower than its p95 latency
+    "hedge": False,
+}
+
+
+# the TokenStore shared by the jobs of a run
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def configure(endpoints: dict):
+    global _shared
+    settings.update(endpoints.get("sora-rpc", {}))
+    # the next jobs use the new hosts
+    with _shared_lock:
+        _shared = None
+
+
+def shared_store():
+    """
+    Returns the TokenStore of the run, created on first use. All jobs share its connections,
+    asset list download and lookups.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = TokenStore()
+        return _shared
+
 
 class TokenStore:
+    """
+    Asset metadata and supplies, fetched from the sora-rpc hosts and cached. It is safe to use
+    from several threads: requests take turns on the connections, and concurrent lookups of the
+    same asset or supply wait for one request instead of sending their own.
+    """
+
     def __init__(self):
         self.store = dict()
-        self.hosts = ["wss://sora.api.onfinality.io/public-ws",
-                      "wss://ws.mof.sora.org/",
-                      "wss://mof2.sora.org/",
-                      "wss://mof3.sora.org/"]
-        self.host = 0
-        self._ws_reset()
-        self._init_store()
+        self.hosts = HostPool(settings["hosts"])
+        self.timeout = settings["timeout"]
+        self.hedge = settings["hedge"]
+        self.connections = dict()
+        self.ids = itertools.count()
+        # held for a whole round trip, responses of one are never read by another
+        self.io_lock = threading.Lock()
+        self.token_flights = SingleFlight()
+        self.supply_flights = SingleFlight()
+        self.cache = AssetCache()
+        self.store.update(self.cache.tokens)
+        # LRU of (asset id, block hash) -> total supply in base units
+        self.supplies = OrderedDict()
+        # supplies fetched by prefetch_supplies and not looked up yet, their first lookup is a miss
+        self.prefetched = set()
+        self.supplies_lock = threading.Lock()
+        # a fresh cache covers everything registered before the last sync,
+        # newer assets are fetched one by one on first use
+        if not self.cache.is_fresh():
+            self._init_store()
 
     def _init_store(self):
-        req_info = {"id": self.id, "jsonrpc": "2.0", "method": "assets_listAssetInfos",
-                    "params": []}
-        req = self._reliable_send(json.dumps(req_info))
+        tokens = self._request("assets_listAssetInfos", [])
+
+        if tokens is None:
+            if len(self.store) > 0:
+                # keep the stale cache
+                return
 
-        if req is None:
             # default store
             self.store = {
                 "0x0200000000000000000000000000000000000000000000000000000000000000": Token("SORA", "XOR", 18),
@@ -36,84 +104,339 @@ class TokenStore:
             }
             return
 
-        self.id += 1
-
-        tokens = json.loads(req)
         for elem in tokens["result"]:
             self.store[elem["asset_id"]] = Token(elem["name"], elem["symbol"], elem["precision"])
 
-    def _get_host(self):
-        host = self.hosts[self.host]
-        self.host += 1
-        self.host %= len(self.hosts)
-        return host
+        self.cache.update(self.store, synced=True)
+
+    def _connection(self, host):
+        if host.url not in self.connections:
+            self.connections[host.url] = create_connection(host.url, timeout=self.timeout)
+        return self.connections[host.url]
 
-    def _ws_reset(self):
-        self.ws = create_connection(self._get_host())
-        self.id = 0
+    def _drop(self, host):
+        ws = self.connections.pop(host.url, None)
+        if ws is not None:
+            ws.close()
 
     def __del__(self):
-        self.ws.close()
+        for ws in self.connections.values():
+            ws.close()
 
-    def get_asset_amount(self, asset_id: str):
-        if asset_id not in self.store:
-            if not self._fetch_token(asset_id):
-                return 0
+    def _lookup(self, asset_id):
+        if asset_id in self.store:
+            metrics.count("asset-cache.hits")
+            return True
+        metrics.count("asset-cache.misses")
+        self.token_flights.run([asset_id], lambda asset_ids: self._fetch_token(asset_ids[0]))
+        return asset_id in self.store
 
-        precision = self.store[asset_id].precision
+    def _known_supply(self, key):
+        with self.supplies_lock:
+            if key in self.supplies:
+                self.supplies.move_to_end(key)
+                return self.supplies[key]
+
+        balance = self.cache.supplies.get(key)
+        if balance is not None:
+            self._remember_supply(key, balance)
+        return balance
+
+    def _remember_supply(self, key, balance):
+        with self.supplies_lock:
+            self.supplies[key] = balance
+            self.supplies.move_to_end(key)
+            if len(self.supplies) > cache.settings["supply-lru-size"]:
+                evicted, _ = self.supplies.popitem(last=False)
+                self.prefetched.discard(evicted)
+
+    def _fetch_supplies(self, keys):
+        """
+        Requests the total supplies of (asset id, block hash) pairs in one pipelined round trip.
+        Supplies at a block are saved to the asset cache, the ones without a block hash are the
+        current supply and are not cached.
+        """
+        reqs = []
+        for asset_id, block_hash in keys:
+            params = [asset_id] if block_hash is None else [asset_id, block_hash]
+            reqs.append({"id": next(self.ids), "jsonrpc": "2.0", "method": "assets_totalSupply", "params": params})
+
+        responses = self._reliable_send_many(reqs)
+
+        balances = dict()
+        for key, req in zip(keys, reqs):
+            supply = responses.get(req["id"])
+            if supply is None or not isinstance(supply.get("result"), dict) or "balance" not in supply["result"]:
+                continue
+            balances[key] = int(supply["result"]["balance"])
 
-        req_supply = {"id": self.id, "jsonrpc": "2.0", "method": "assets_totalSupply",
-                      "params": [asset_id]}
-        rcv = self._reliable_send(json.dumps(req_supply))
-        if rcv is None:
+        fixed = {key: balance for key, balance in balances.items() if key[1] is not None}
+        for key, balance in fixed.items():
+            self._remember_supply(key, balance)
+        if len(fixed) > 0:
+            self.cache.supplies.update(fixed)
+
+        return balances
+
+    def prefetch_supplies(self, keys):
+        """
+        Resolves the total supplies of the (asset id, block hash) pairs that are not cached yet
+        with a single pipelined round trip.
+        """
+        unknown = sorted({key for key in keys if key[1] is not None and self._known_supply(key) is None})
+        if len(unknown) == 0:
+            return
+        metrics.count("sora-rpc.prefetched", len(unknown))
+        self.supply_flights.run(unknown, self._fetch_supplies)
+        with self.supplies_lock:
+            self.prefetched.update(unknown)
+
+    def get_asset_amount(self, asset_id: str, block_hash=None):
+        """
+        Total supply of the asset at the block, or the current one without a block hash.
+        """
+        if not self._lookup(asset_id):
             return 0
-        supply = json.loads(rcv)
-        self.id += 1
 
-        if "balance" not in supply["result"]:
+        precision = self.store[asset_id].precision
+
+        key = (asset_id, block_hash)
+        if block_hash is None:
+            balance = self._fetch_supplies([key]).get(key)
+        else:
+            # every lookup is counted once, here
+            balance = self._known_supply(key)
+            with self.supplies_lock:
+                prefetched = key in self.prefetched
+                self.prefetched.discard(key)
+            metrics.count("supply-cache.hits" if balance is not None and not prefetched else "supply-cache.misses")
+            if balance is None:
+                self.supply_flights.run([key], self._fetch_supplies)
+                balance = self._known_supply(key)
+        if balance is None:
             return 0
 
-        return set_precision(supply["result"]["balance"], int(precision))
+        return Amount(balance, int(precision))
 
     def get_asset_ticker(self, asset_id: str):
-        if asset_id not in self.store:
-            if not self._fetch_token(asset_id):
-                return asset_id
+        if not self._lookup(asset_id):
+            return asset_id
 
         return self.store[asset_id].ticker
 
     def get_asset_precision(self, asset_id: str):
-        if asset_id not in self.store:
-            if not self._fetch_token(asset_id):
-                return 0
+        if not self._lookup(asset_id):
+            return 0
 
         return int(self.store[asset_id].precision)
 
-    def _reliable_send(self, req: str):
-        i = len(self.hosts)
-        while i > 0:
+    def _request(self, method, params):
+        req = {"id": next(self.ids), "jsonrpc": "2.0", "method": method, "params": params}
+        return self._reliable_send(req)
+
+    def _reliable_send(self, req: dict):
+        """
+        Sends the request to the fastest healthy host, falling back to the next ones on errors
+        and timeouts. With hedging enabled, a request that is slower than the host's p95 latency
+        is also sent to the next host and the first response wins.
+        """
+        with self.io_lock, metrics.timer("sora-rpc.request"):
+            return self._send(req)
+
+    def _send(self, req: dict):
+        hosts = self.hosts.ranked()
+        for i, host in enumerate(hosts):
             try:
-                self.ws.send(req)
-                return self.ws.recv()
-            except websocket.WebSocketConnectionClosedException:
-                self._ws_reset()
-                i -= 1
-                continue
+                with limit("sora-rpc", host.url):
+                    start = time.monotonic()
+                    ws = self._connection(host)
+                    ws.send(json.dumps(req))
+
+                    backup = hosts[i + 1] if self.hedge and i + 1 < len(hosts) else None
+                    p95 = host.p95()
+                    if backup is not None and p95 is not None and len(_readable([ws], p95)) == 0:
+                        return self._hedged_recv(req, ws, host, backup, start)
+
+                    rcv = _recv(ws, {req["id"]})
+                    host.record(time.monotonic() - start)
+                    return rcv
+            except (websocket.WebSocketException, OSError):
+                metrics.count("sora-rpc.failures")
+                host.fail()
+                self._drop(host)
         return None
 
-    def _fetch_token(self, asset_id):
-        req_info = {"id": self.id, "jsonrpc": "2.0", "method": "assets_getAssetInfo",
-                    "params": [asset_id]}
-        rcv = self._reliable_send(json.dumps(req_info))
-        if rcv is None:
+    def _hedged_recv(self, req: dict, ws, host, backup, start):
+        try:
+            backup_ws = self._connection(backup)
+            backup_ws.send(json.dumps(req))
+        except (websocket.WebSocketException, OSError):
+            backup.fail()
+            self._drop(backup)
+            rcv = _recv(ws, {req["id"]})
+            host.record(time.monotonic() - start)
+            return rcv
+
+        racers = {ws: host, backup_ws: backup}
+        deadline = start + self.timeout
+        while len(racers) > 0:
+            ready = _readable(list(racers), deadline - time.monotonic())
+            if len(ready) == 0:
+                break
+
+            for conn in ready:
+                try:
+                    rcv = json.loads(conn.recv())
+                except (websocket.WebSocketException, OSError):
+                    if racers[conn] is not host:
+                        racers[conn].fail()
+                        self._drop(racers.pop(conn))
+                        continue
+                    raise
+
+                # the loser's response is skipped by _recv when the connection is reused
+                if rcv.get("id") == req["id"]:
+                    racers[conn].record(time.monotonic() - start)
+                    return rcv
+
+        raise websocket.WebSocketTimeoutException("hedged request timed out")
+
+    def _reliable_send_many(self, reqs: list):
+        """
+        Pipelines requests over the connection: everything is sent before the first response
+        is read, responses are matched by id. Returns id -> response for the answered requests.
+        """
+        with self.io_lock:
+            return self._send_many(reqs)
+
+    def _send_many(self, reqs: list):
+        responses = dict()
+        for host in self.hosts.ranked():
+            pending = [req for req in reqs if req["id"] not in responses]
+            if len(pending) == 0:
+                break
+
+            try:
+                with limit("sora-rpc", host.url, len(pending)), metrics.timer("sora-rpc.pipeline"):
+                    start = time.monotonic()
+                    ws = self._connection(host)
+                    for req in pending:
+                        ws.send(json.dumps(req))
+                    ids = {req["id"] for req in pending}
+                    while len(ids) > 0:
+                        rcv = _recv(ws, ids)
+                        responses[rcv["id"]] = rcv
+                        ids.remove(rcv["id"])
+                    host.record((time.monotonic() - start) / len(pending))
+            except (websocket.WebSocketException, OSError):
+                metrics.count("sora-rpc.failures")
+                host.fail()
+                self._drop(host)
+        return responses
+
+    def prefetch(self, asset_ids):
+        """
+        Resolves all unknown asset ids with a single pipelined round trip.
+        """
+        unknown = {asset_id for asset_id in asset_ids if asset_id not in self.store}
+        if len(unknown) == 0:
+            return
+        self.token_flights.run(sorted(unknown), self._fetch_tokens)
+
+    def _fetch_tokens(self, asset_ids):
+        # the lookups of the page are hits once the assets are fetched, the misses are counted here
+        metrics.count("asset-cache.misses", len(asset_ids))
+        metrics.count("sora-rpc.prefetched", len(asset_ids))
+
+        reqs = []
+        for asset_id in asset_ids:
+            reqs.append({"id": next(self.ids), "jsonrpc": "2.0", "method": "assets_getAssetInfo",
+                         "params": [asset_id]})
+
+        responses = self._reliable_send_many(reqs)
+
+        tokens = dict()
+        for req in reqs:
+            info = responses.get(req["id"])
+            if info is None:
+                continue
+            asset_id = req["params"][0]
+            if self._add_token(asset_id, info):
+                tokens[asset_id] = self.store[asset_id]
+
+        if len(tokens) > 0:
+            self.cache.update(tokens)
+
+    def _add_token(self, asset_id, info):
+        if "result" not in info or info["result"] is None:
             return False
-        info = json.loads(rcv)
-        self.id += 1
 
         if "symbol" not in info["result"] or len(info["result"]["symbol"]) == 0:
             return False
 
         self.store[asset_id] = Token(info["result"]["name"], info["result"]["symbol"],
                                      int(info["result"]["precision"]))
+        return True
+
+    def _fetch_token(self, asset_id):
+        info = self._request("assets_getAssetInfo", [asset_id])
+        if info is None:
+            return False
+
+        if not self._add_token(asset_id, info):
+            return False
+
+        self.cache.update({asset_id: self.store[asset_id]})
 
         return True
+
+    def snapshot(self, asset_ids, supply_keys):
+        """
+        Copies what normalizing a page needs into a StoreSnapshot, resolving the supplies of the
+        (asset id, block hash) pairs here.
+        """
+        tokens = {asset_id: self.store[asset_id] for asset_id in asset_ids if asset_id in self.store}
+        supplies = {key: self.get_asset_amount(*key) for key in supply_keys}
+        return StoreSnapshot(tokens, supplies)
+
+
+class StoreSnapshot:
+    """
+    Read-only TokenStore stand-in sent to normalization workers, it never does network requests.
+    """
+
+    def __init__(self, tokens: dict, supplies: dict):
+        self.tokens = tokens
+        self.supplies = supplies
+
+    def get_asset_amount(self, asset_id: str, block_hash=None):
+        return self.supplies.get((asset_id, block_hash), 0)
+
+    def get_asset_ticker(self, asset_id: str):
+        if asset_id not in self.tokens:
+            return asset_id
+        return self.tokens[asset_id].ticker
+
+    def get_asset_precision(self, asset_id: str):
+        if asset_id not in self.tokens:
+            return 0
+        return int(self.tokens[asset_id].precision)
+
+
+def _recv(ws, ids: set):
+    # responses of abandoned hedged requests may still be queued on the connection
+    while True:
+        raw = ws.recv()
+        metrics.count("sora-rpc.bytes", len(raw))
+        rcv = json.loads(raw)
+        if rcv.get("id") in ids:
+            return rcv
+
+
+def _readable(connections: list, timeout):
+    ready = [ws for ws in connections if hasattr(ws.sock, "pending") and ws.sock.pending() > 0]
+    if len(ready) > 0:
+        return ready
+
+    readable, _, _ = select.select([ws.sock for ws in connections], [], [], max(timeout, 0))
+    return [ws for ws in connections if ws.sock in readable]
@@ -1,69 +1,238 @@
-from etherscan import Etherscan
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import dotenv_values
 from datetime import datetime
-from utils.precision import set_precision
-import pandas as pd
-import os
+import heapq
+from models.checkpoint import Checkpoint
+from models.db import open_store
+from models.report import ReportWriter, columns
+from networks.etherscan_client import EtherscanClient, EtherscanError, settings
+from utils import metrics
+from utils.batch import RowBatch
+from utils.http_cache import cached
+from utils.precision import Amount
 
 
-def eth_process(base_path, address, from_block):
-    config = dotenv_values(".env")
-    client = Etherscan(config["ETHERSCAN_KEY"])
+# Etherscan lists of an address, joined by transaction hash in this order
+sources = ("get_normal_txs_by_address", "get_internal_txs_by_address", "get_erc20_token_transfer_events_by_address")
+
+
+# errors that depend only on the request, they are cached like results. Others, such as
+# rate limit or API key errors, are raised without being saved.
+deterministic_errors = ("No transactions found", "Result window is too large")
+
+
+class WindowTooLarge(Exception):
+    pass
+
+
+def fetch_page(client, source, address, low, high, page):
+    params = {"address": address, "startblock": low, "endblock": high, "sort": "desc",
+              "page": page, "offset": settings["page-size"]}
+
+    def fetch():
+        try:
+            return {"result": getattr(client, source)(**params)}
+        except EtherscanError as e:
+            if not any(error in str(e) for error in deterministic_errors):
+                raise
+            return {"error": str(e)}
+
+    response = cached("etherscan", source, params, fetch)
+    if "error" in response:
+        if "No transactions found" in response["error"]:
+            return []
+        if "Result window is too large" in response["error"]:
+            raise WindowTooLarge()
+        # saved by an earlier version that cached every error
+        raise EtherscanError(response["error"])
+
+    return response["result"]
+
+
+def fetch_window(client, source, address, low, high):
+    """
+    Returns the entries of blocks low..high (inclusive) in descending block order, and whether
+    the window was split in halves because it holds more results than one query can return.
+    """
+    page_size = settings["page-size"]
+    txs = []
+    page = 1
+    try:
+        while True:
+            if page * page_size > settings["result-window"]:
+                raise WindowTooLarge()
+
+            result = fetch_page(client, source, address, low, high, page)
+            txs.extend(result)
+            if len(result) < page_size:
+                return txs, False
+            page += 1
+    except WindowTooLarge:
+        if low == high:
+            print("WARN: Block {} has more than {} entries of {} for {}, the rest is skipped".format(
+                low, len(txs), source, address))
+            return txs, True
+
+        middle = (low + high) // 2
+        upper, _ = fetch_window(client, source, address, middle + 1, high)
+        lower, _ = fetch_window(client, source, address, low, middle)
+        return upper + lower, True
+
+
+def fetch_windows(client, address, from_block, to_block):
+    """
+    Yields the entries of every source between from_block and to_block (inclusive) window by
+    window, from the highest block down, as one list per source. The sources of up to
+    `concurrency` windows are fetched at once; the next windows are halved after a window was
+    split and doubled after a sparse one.
+    """
+    concurrency = settings["concurrency"]
+    size = settings["window"]
+    high = to_block
+    pending = deque()
+    with ThreadPoolExecutor(concurrency * len(sources)) as executor:
+        while high >= from_block or pending:
+            while high >= from_block and len(pending) < concurrency:
+                low = max(from_block, high - size + 1)
+                pending.append([executor.submit(metrics.propagate(fetch_window), client, source, address, low, high)
+                                for source in sources])
+                high = low - 1
+
+            results = [future.result() for future in pending.popleft()]
+            if any(split for _, split in results):
+                size = max(size // 2, 1)
+            elif max(len(txs) for txs, _ in results) < settings["page-size"] // 2:
+                size *= 2
+            yield [txs for txs, _ in results]
+
 
-    columns = {"scan": "Scan Tool", "network": "Data Source", "timestamp": "Time Stamp", "date": "Date and Time (UTC)",
-               "height": "Block height", "tx_hash": "Transaction hash", "line": "Line Number",
-               "type": "Transaction Type", "amount": "Token amount", "ticker": "Token ticker",
-               "send_or_receive": "Sender or Receiver", "sender": "Sending wallet",
-               "receiver": "Receiving side address",
-               "network_fee": "Network fee amount", "fee_ticker": "Network fee token ticker",
-               "lp_fee": "Liquidity Provider Fee",
-               "lp_fee_ticker": "Liquidity Provider Fee token ticker"}
+def join_by_hash(lists):
+    """
+    Groups the entries of lists sorted by descending block by transaction hash, in one pass over
+    their merge. Returns hash -> one list of entries per input list, in descending block order.
+    """
+    merged = heapq.merge(*[[(-int(tx["blockNumber"]), i, tx) for tx in txs] for i, txs in enumerate(lists)],
+                         key=lambda entry: entry[:2])
+    groups = dict()
+    for _, i, tx in merged:
+        group = groups.get(tx["hash"])
+        if group is None:
+            group = groups[tx["hash"]] = tuple([] for _ in lists)
+        group[i].append(tx)
+    return groups
 
+
+def direction(account, tx):
+    return {"send_or_receive": "S" if tx["from"] == account else "R", "sender": tx["from"], "receiver": tx["to"]}
+
+
+def transaction_rows(account, normal, internal, transfers):
+    rows = []
+    for tx in normal:
+        if tx.get("isError") == "1":
+            rows.append({**direction(account, tx), "type": "failed"})
+        elif int(tx["value"]) > 0:
+            rows.append({**direction(account, tx), "type": "transfer",
+                         "amount": Amount(int(tx["value"]), 18), "ticker": "ETH"})
+        elif len(internal) == 0 and len(transfers) == 0:
+            # a contract call that moved no funds, only its fee is reported
+            function = tx.get("functionName", "").split("(")[0]
+            rows.append({**direction(account, tx), "type": function or "call"})
+
+    for tx in internal:
+        if tx.get("isError") == "1":
+            continue
+        rows.append({**direction(account, tx), "type": "internal",
+                     "amount": Amount(int(tx["value"]), 18), "ticker": "ETH"})
+
+    for tx in transfers:
+        rows.append({**direction(account, tx), "type": "transfer",
+                     "amount": Amount(int(tx["value"]), int(tx["tokenDecimal"])), "ticker": tx["tokenSymbol"]})
+
+    return rows
+
+
+def append_transactions(address, lists, transactions: RowBatch):
+    """
+    Joins a window of normal txs, internal txs and token transfers by hash into report rows. The fee
+    (gasUsed * gasPrice) is paid by the sender of the transaction and is reported on its first row.
+    """
+    account = address.lower()
     transaction_template = dict.fromkeys(columns.keys(), "")
 
-    transactions = pd.DataFrame()
+    for tx_hash, (normal, internal, transfers) in join_by_hash(lists).items():
+        rows = transaction_rows(account, normal, internal, transfers)
+        if len(rows) == 0:
+            continue
+
+        first = (normal + internal + transfers)[0]
+        base = transaction_template.copy()
+        base["scan"] = "EtherScan"
+        base["network"] = "ETH Main Net"
+        base["timestamp"] = first["timeStamp"]
+        base["date"] = datetime.utcfromtimestamp(int(first["timeStamp"])).strftime('%Y-%m-%d %H:%M:%S')
+        base["height"] = first["blockNumber"]
+        base["tx_hash"] = tx_hash
+
+        fee = ""
+        if len(normal) > 0 and normal[0]["from"] == account:
+            fee = Amount(int(normal[0]["gasUsed"]) * int(normal[0]["gasPrice"]), 18)
+
+        for i, row in enumerate(rows):
+            transaction = {**base, **row, "line": i + 1}
+            if i == 0 and fee != "":
+                transaction["network_fee"] = fee
+                transaction["fee_ticker"] = "ETH"
+            transactions.append(transaction)
+
+
+def eth_process(base_path, address, from_block, to_block, incremental=False, finalized=False):
+    """
+    With `finalized`, to_block is final and the checkpoint moves to it also when it has no rows.
+    """
+    config = dotenv_values(".env")
+    client = EtherscanClient(config["ETHERSCAN_KEY"])
+
+    # also kept without incremental, for the partial report of a failed scan
+    checkpoint = Checkpoint(base_path, "ethereum", address, from_block)
+    start_block = from_block
+    if incremental and checkpoint.block is not None:
+        # startblock is inclusive
+        start_block = checkpoint.block + 1
+
+    # the blocks of a partial report left by a failed scan are not fetched again
+    partial = checkpoint.resume(start_block, to_block)
+    ranges = [(start_block, to_block)]
+    if partial is not None:
+        ranges = [(partial["to-block"] + 1, to_block), (start_block, partial["block"])]
+
+    transactions = RowBatch(columns)
+
+    previous = checkpoint.report if incremental else None
+    db = open_store("ethereum", address)
+    writer = ReportWriter(base_path, "ETH", address, from_block, previous, partial=partial)
     try:
-        res = client.get_erc20_token_transfer_events_by_address(address=address,
-                                                                startblock=from_block,
-                                                                endblock=99999999,
-                                                                sort="desc")
-    except AssertionError as e:
-        estr = str(e)
-        if "No transactions found" in estr:
-            return
-        if "Result window is too large" in estr:
-            return
-        print(estr)
-        return
-
-    for tx in res:
-        transaction = transaction_template.copy()
-        transaction["scan"] = "EtherScan"
-        transaction["network"] = "ETH Main Net"
-        transaction["timestamp"] = tx["timeStamp"]
-        transaction["date"] = datetime.utcfromtimestamp(int(tx["timeStamp"])).strftime('%Y-%m-%d %H:%M:%S')
-        transaction["height"] = tx["blockNumber"]
-        transaction["tx_hash"] = tx["hash"]
-        transaction["line"] = 1
-        transaction["network_fee"] = tx["gas"]
-        transaction["fee_ticker"] = "Gwei"
-
-        transaction["type"] = "transfer"
-
-        transaction["amount"] = set_precision(tx["value"], int(tx["tokenDecimal"]))
-        transaction["ticker"] = tx["tokenSymbol"]
-
-        transaction["send_or_receive"] = "S" if tx["from"] == address else "R"
-        transaction["sender"] = tx["from"]
-        transaction["receiver"] = tx["to"]
-
-        transactions = transactions.append(transaction, ignore_index=True)
-
-    if transactions.empty:
-        return
-
-    to_block = transactions.head(1)["height"].values[0]
-    stime = datetime.now().strftime("%H:%M %d.%m.%y")
-    name = f"ETH {stime} {address[:4]}...{address[-4:]} ({from_block}:{to_block}]"
-    filepath = os.path.join(base_path, f"{name}.csv")
-    transactions.rename(columns=columns).to_csv(filepath)
+        for low, high in ranges:
+            for lists in fetch_windows(client, address, low, high):
+                with metrics.timer("normalize"):
+                    append_transactions(address, lists, transactions)
+                writer.write(transactions)
+                if db is not None:
+                    db.write(transactions)
+                transactions.clear()
+    except BaseException:
+        kept = writer.abort(keep=True)
+        if kept is not None:
+            checkpoint.save_partial(kept, start_block, to_block)
+        raise
+    finally:
+        if db is not None:
+            db.close()
+    writer.close()
+
+    block = max(to_block, start_block - 1) if finalized else writer.to_block
+    if incremental and block is not None:
+        checkpoint.save(block, writer.path)
+    else:
+        checkpoint.clear_partial()
@@ -0,0 +1,74 @@
+from utils import metrics
+from utils.ratelimit import limit
+
+import requests
+
+settings = {
+    "url": "https://api.etherscan.io/api",
+    # seconds to wait for a response
+    "timeout": 60,
+    # results per page, the API returns at most `result-window` results of a query over all its pages
+    "page-size": 1000,
+    "result-window": 10000,
+    # blocks in the first window of a scan, then halved when full and doubled when sparse
+    "window": 100000,
+    # windows fetched at the same time, requests are still limited by the endpoint rate
+    "concurrency": 4,
+}
+
+
+def configure(endpoints: dict):
+    settings.update(endpoints.get("etherscan", {}))
+
+
+class EtherscanError(Exception):
+    """
+    An error status returned by the Etherscan API, with the `result -- message` text.
+    """
+
+
+class EtherscanClient:
+    """
+    Minimal Etherscan API client over a keep-alive session. Error responses are raised as
+    EtherscanError.
+    """
+
+    def __init__(self, api_key: str, url=None):
+        self.api_key = api_key
+        self.url = url or settings["url"]
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = ""
+
+    def _get(self, params: dict):
+        params["apikey"] = self.api_key
+        with limit("etherscan"), metrics.timer("etherscan.request"):
+            response = self.session.get(self.url, params=params, timeout=settings["timeout"])
+        metrics.count("etherscan.bytes", len(response.content))
+        content = response.json()
+        result = content["result"]
+        if "status" in content and not int(content["status"]):
+            raise EtherscanError(f"{result} -- {content['message']}")
+        return result
+
+    def get_block_number(self):
+        return int(self._get({"module": "proxy", "action": "eth_blockNumber"}), 16)
+
+    def _account_list(self, action: str, address: str, startblock: int, endblock: int, sort: str, page, offset):
+        params = {"module": "account", "action": action, "address": address,
+                  "startblock": startblock, "endblock": endblock, "sort": sort}
+        if page is not None:
+            params["page"] = page
+            params["offset"] = offset
+        return self._get(params)
+
+    def get_normal_txs_by_address(self, address: str, startblock: int, endblock: int, sort: str,
+                                  page=None, offset=None):
+        return self._account_list("txlist", address, startblock, endblock, sort, page, offset)
+
+    def get_internal_txs_by_address(self, address: str, startblock: int, endblock: int, sort: str,
+                                    page=None, offset=None):
+        return self._account_list("txlistinternal", address, startblock, endblock, sort, page, offset)
+
+    def get_erc20_token_transfer_events_by_address(self, address: str, startblock: int, endblock: int, sort: str,
+                                                   page=None, offset=None):
+        return self._account_list("tokentx", address, startblock, endblock, sort, page, offset)
@@ -1,23 +1,48 @@
-from models.store import TokenStore, set_precision
+from models.checkpoint import Checkpoint
+from models.db import open_store
+from models.report import ReportWriter, columns
+from models.store import shared_store
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import gql
-from gql.transport.aiohttp import AIOHTTPTransport
+import multiprocessing as mp
 import pandas as pd
-from datetime import datetime
-from utils import ss58
-import os
+import threading
+from networks import subquery
+from utils import metrics, ss58
+from utils.batch import RowBatch
+from utils.precision import Amount
+
+settings = {
+    # processes normalizing pages, 0 normalizes on the thread of the job
+    "normalize-workers": 0,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configure(options: dict):
+    if "normalize-workers" in options:
+        settings["normalize-workers"] = options["normalize-workers"]
+
 
-# Select your transport with a defined url endpoint
-transport = AIOHTTPTransport(url="https://api.subquery.network/sq/sora-xor/sora-prod-sub4")
+def get_executor():
+    global _executor
+    if settings["normalize-workers"] <= 0:
+        return None
 
-# Create a GraphQL client using the defined transport
-client = gql.Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=None)
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(settings["normalize-workers"], mp_context=mp.get_context("spawn"))
+        return _executor
 
 
 class Context:
 
-    def __init__(self, address):
-        self.store = TokenStore()
+    def __init__(self, address, store=None):
+        self.store = store if store is not None else shared_store()
         self.address = address
 
 
@@ -32,6 +57,7 @@ query HistoryElements(
   $orderBy: [HistoryElementsOrderBy!] = TIMESTAMP_DESC
   $filter: HistoryElementFilter
   $idsOnly: Boolean! = false
+  $withCount: Boolean! = false
 ) {
   historyElements(
     first: $first
@@ -62,283 +88,473 @@ query HistoryElements(
       startCursor
       endCursor
     }
-    totalCount @skip(if: $idsOnly)
+    totalCount @include(if: $withCount)
   }
 }
 """
 )
 
 
-def process_transfer(context: Context, node, transaction):
-    transaction["amount"] = node["data"]["amount"]
-    transaction["ticker"] = context.store.get_asset_ticker(node["data"]["assetId"])
-    transaction["send_or_receive"] = "S" if node["data"]["from"] == context.address else "R"
-    transaction["sender"] = node["data"]["from"]
-    transaction["receiver"] = node["data"]["to"]
-    return [transaction]
+asset_id_keys = {"assetId", "baseAssetId", "targetAssetId", "input_asset_a", "input_asset_b"}
 
 
-def process_refferals(context: Context, node, transaction):
-    transaction["amount"] = node["data"]["amount"]
-    transaction["ticker"] = "XOR"
-    transaction["send_or_receive"] = "S" if node["data"]["from"] == context.address else "R"
-    if transaction["send_or_receive"] == "S":
-        transaction["sender"] = node["data"]["from"]
-    elif transaction["send_or_receive"] == "R":
-        transaction["receiver"] = node["data"]["to"]
-    return [transaction]
+def collect_asset_ids(data, asset_ids: set):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in asset_id_keys and isinstance(value, str):
+                asset_ids.add(value)
+            else:
+                collect_asset_ids(value, asset_ids)
+    elif isinstance(data, list):
+        for elem in data:
+            collect_asset_ids(elem, asset_ids)
 
+    return asset_ids
 
-def process_swap(context: Context, node, transaction):
-    from_transaction = transaction.copy()
-    from_transaction["lp_fee"] = node["data"]["liquidityProviderFee"]
-    from_transaction["lp_fee_ticker"] = "XOR"
-    from_transaction["amount"] = node["data"]["baseAssetAmount"]
-    from_transaction["ticker"] = context.store.get_asset_ticker(node["data"]["baseAssetId"])
-    from_transaction["send_or_receive"] = "S"
-    from_transaction["sender"] = context.address
 
-    transaction["line"] = 2
-    transaction["network_fee"] = ""
-    transaction["fee_ticker"] = ""
-    transaction["amount"] = node["data"]["targetAssetAmount"]
-    transaction["ticker"] = context.store.get_asset_ticker(node["data"]["targetAssetId"])
-    transaction["send_or_receive"] = "R"
-    transaction["receiver"] = context.address
+# (module, method) -> handler(context, node) returning the rows of the node. A row only holds
+# the fields that differ from the base row of the node built by normalize_page.
+handlers = dict()
 
-    return [from_transaction, transaction]
 
+def handler(module, *methods):
+    def register(fn):
+        for method in methods:
+            handlers[(module, method)] = fn
+        return fn
 
-def process_pool(context: Context, node, transaction):
-    if node["method"] == "withdrawLiquidity":
-        transaction["send_or_receive"] = "R"
-        transaction["receiver"] = context.address
-    else:
-        transaction["send_or_receive"] = "S"
-        transaction["sender"] = context.address
+    return register
 
-    from_transaction = transaction.copy()
-    from_transaction["amount"] = node["data"]["baseAssetAmount"]
-    from_transaction["ticker"] = context.store.get_asset_ticker(node["data"]["baseAssetId"])
 
-    transaction["line"] = 2
-    transaction["network_fee"] = ""
-    transaction["fee_ticker"] = ""
-    transaction["amount"] = node["data"]["targetAssetAmount"]
-    transaction["ticker"] = context.store.get_asset_ticker(node["data"]["targetAssetId"])
+def process_default(context: Context, node):
+    return [{}]
 
-    return [from_transaction, transaction]
 
+def process_failed(context: Context, node):
+    return [{"type": "failed"}]
 
-def process_to_bridge(context: Context, node, transaction):
-    transaction["amount"] = node["data"]["amount"]
-    transaction["ticker"] = context.store.get_asset_ticker(node["data"]["assetId"])
-    transaction["send_or_receive"] = "S"
-    transaction["sender"] = context.address
-    transaction["receiver"] = node["data"]["sidechainAddress"]
-
-    return [transaction]
 
+@handler("assets", "transfer")
+def process_transfer(context: Context, node):
+    data = node["data"]
+    return [{"amount": Amount.parse(data["amount"]),
+             "ticker": context.store.get_asset_ticker(data["assetId"]),
+             "send_or_receive": "S" if data["from"] == context.address else "R",
+             "sender": data["from"],
+             "receiver": data["to"]}]
 
-def process_register(context: Context, node, transaction):
-    transaction["amount"] = context.store.get_asset_amount(node["data"]["assetId"])
-    transaction["ticker"] = context.store.get_asset_ticker(node["data"]["assetId"])
-    transaction["send_or_receive"] = "R"
-    transaction["receiver"] = context.address
 
+@handler("referrals", "reserve", "unreserve")
+def process_refferals(context: Context, node):
+    data = node["data"]
+    transaction = {"amount": Amount.parse(data["amount"]), "ticker": "XOR"}
+    if data["from"] == context.address:
+        transaction["send_or_receive"] = "S"
+        transaction["sender"] = data["from"]
+    else:
+        transaction["send_or_receive"] = "R"
+        transaction["receiver"] = data["to"]
     return [transaction]
 
 
-def process_reward(context: Context, node, transaction):
-    transaction["send_or_receive"] = "R"
-    transaction["receiver"] = context.address
-
+@handler("liquidityProxy", "swap")
+def process_swap(context: Context, node):
+    data = node["data"]
+    return [{"lp_fee": Amount.parse(data["liquidityProviderFee"]),
+             "lp_fee_ticker": "XOR",
+             "amount": Amount.parse(data["baseAssetAmount"]),
+             "ticker": context.store.get_asset_ticker(data["baseAssetId"]),
+             "send_or_receive": "S",
+             "sender": context.address},
+            {"line": 2,
+             "network_fee": "",
+             "fee_ticker": "",
+             "amount": Amount.parse(data["targetAssetAmount"]),
+             "ticker": context.store.get_asset_ticker(data["targetAssetId"]),
+             "send_or_receive": "R",
+             "receiver": context.address}]
+
+
+@handler("poolXYK", "depositLiquidity", "withdrawLiquidity")
+def process_pool(context: Context, node):
+    data = node["data"]
+    if node["method"] == "withdrawLiquidity":
+        direction = {"send_or_receive": "R", "receiver": context.address}
+    else:
+        direction = {"send_or_receive": "S", "sender": context.address}
+
+    return [{**direction,
+             "amount": Amount.parse(data["baseAssetAmount"]),
+             "ticker": context.store.get_asset_ticker(data["baseAssetId"])},
+            {**direction,
+             "line": 2,
+             "network_fee": "",
+             "fee_ticker": "",
+             "amount": Amount.parse(data["targetAssetAmount"]),
+             "ticker": context.store.get_asset_ticker(data["targetAssetId"])}]
+
+
+@handler("ethBridge", "transferToSidechain")
+def process_to_bridge(context: Context, node):
+    data = node["data"]
+    return [{"amount": Amount.parse(data["amount"]),
+             "ticker": context.store.get_asset_ticker(data["assetId"]),
+             "send_or_receive": "S",
+             "sender": context.address,
+             "receiver": data["sidechainAddress"]}]
+
+
+@handler("assets", "register")
+def process_register(context: Context, node):
+    asset_id = node["data"]["assetId"]
+    # the supply right after the registration, not the current one
+    return [{"amount": context.store.get_asset_amount(asset_id, node.get("blockHash")),
+             "ticker": context.store.get_asset_ticker(asset_id),
+             "send_or_receive": "R",
+             "receiver": context.address}]
+
+
+@handler("rewards", "claim")
+@handler("pswapDistribution", "claimIncentive")
+@handler("vestedRewards", "claimRewards", "claimCrowdloanRewards")
+def process_reward(context: Context, node):
     transactions = []
+    for i, elem in enumerate(node["data"]):
+        transaction = {"line": i + 1,
+                       "amount": Amount(int(elem["amount"]), context.store.get_asset_precision(elem["assetId"])),
+                       "ticker": context.store.get_asset_ticker(elem["assetId"]),
+                       "send_or_receive": "R",
+                       "receiver": context.address}
+        # the network fee is reported on the first line only
+        if i > 0:
+            transaction["network_fee"] = ""
+            transaction["fee_ticker"] = ""
+        transactions.append(transaction)
+
+    if len(transactions) == 0:
+        return [{"send_or_receive": "R", "receiver": context.address}]
 
-    fee = transaction["network_fee"]
-    ticker = transaction["fee_ticker"]
+    return transactions
 
-    transaction["network_fee"] = ""
-    transaction["fee_ticker"] = ""
 
-    i = 1
+@handler("utility", "batchAll")
+def process_batch(context: Context, node):
     for elem in node["data"]:
-        new_transaction = transaction.copy()
+        if elem["module"] == "poolXYK" and elem["method"] == "depositLiquidity":
+            args = elem["data"]["args"]
+            deposit = {"module": elem["module"], "method": elem["method"],
+                       "data": {"baseAssetAmount": args["input_a_desired"],
+                                "baseAssetId": args["input_asset_a"],
+                                "targetAssetAmount": args["input_b_desired"],
+                                "targetAssetId": args["input_asset_b"]}}
+            return [{**transaction, "type": elem["method"]} for transaction in process_pool(context, deposit)]
 
-        new_transaction["line"] = i
-        new_transaction["amount"] = set_precision(elem["amount"],
-                                                  context.store.get_asset_precision(elem["assetId"]))
-        new_transaction["ticker"] = context.store.get_asset_ticker(elem["assetId"])
-        transactions.append(new_transaction)
-        i += 1
+    return [{}]
 
-    if len(transaction) > 0:
-        transactions[0]["network_fee"] = fee
-        transactions[0]["fee_ticker"] = ticker
 
-    return transactions
+def normalize_page(context: Context, nodes, batch: RowBatch):
+    """
+    Normalizes a page of history elements into batch. Nodes are grouped by (module, method)
+    and every group goes through its handler, then the columns are built in one pass, in the
+    order of the nodes. Fields shared by all rows of a node are computed once per node.
+    """
+    groups = dict()
+    for i, node in enumerate(nodes):
+        if "execution" in node and not node["execution"]["success"]:
+            key = None
+        else:
+            key = (node["module"], node["method"])
+        groups.setdefault(key, []).append(i)
+
+    node_rows = [None] * len(nodes)
+    for key, indices in groups.items():
+        fn = process_failed if key is None else handlers.get(key, process_default)
+        for i in indices:
+            node_rows[i] = fn(context, nodes[i])
+
+    origins = []
+    rows = []
+    for i, transactions in enumerate(node_rows):
+        origins.extend([i] * len(transactions))
+        rows.extend(transactions)
+
+    if len(rows) == 0:
+        return
 
+    base = {
+        "scan": ["SubQuery"] * len(nodes),
+        "network": ["SORA Main Net"] * len(nodes),
+        "timestamp": [node["timestamp"] for node in nodes],
+        "height": [node["blockHeight"] for node in nodes],
+        "tx_hash": [node["id"] for node in nodes],
+        "line": [1] * len(nodes),
+        "type": [node["method"] for node in nodes],
+        "network_fee": [Amount.parse(node["networkFee"]) for node in nodes],
+        "fee_ticker": ["XOR"] * len(nodes),
+    }
+    base["date"] = pd.to_datetime(base["timestamp"], unit="s").strftime('%Y-%m-%d %H:%M:%S').tolist()
 
-def process_module(context: Context, node, transaction):
-    transaction["type"] = node["method"]
-
-    if "execution" in node and not node["execution"]["success"]:
-        transaction["type"] = "failed"
-        return [transaction]
-
-    if node["module"] == "assets" and node["method"] == "transfer":
-        return process_transfer(context, node, transaction)
-    elif node["module"] == "assets" and node["method"] == "register":
-        return process_register(context, node, transaction)
-    elif node["module"] == "liquidityProxy" and node["method"] == "swap":
-        return process_swap(context, node, transaction)
-    elif node["module"] == "poolXYK" and (
-            node["method"] == "withdrawLiquidity" or node["method"] == "depositLiquidity"):
-        return process_pool(context, node, transaction)
-    elif node["module"] == "ethBridge" and node["method"] == "transferToSidechain":
-        return process_to_bridge(context, node, transaction)
-    elif node["module"] == "utility" and node["method"] == "batchAll":
-
-        for elem in node["data"]:
-            if elem["module"] == "poolXYK" and elem["method"] == "depositLiquidity":
-                elem["data"]["baseAssetAmount"] = elem["data"]["args"]["input_a_desired"]
-                elem["data"]["baseAssetId"] = elem["data"]["args"]["input_asset_a"]
-                elem["data"]["targetAssetAmount"] = elem["data"]["args"]["input_b_desired"]
-                elem["data"]["targetAssetId"] = elem["data"]["args"]["input_asset_b"]
-                return process_module(context, elem, transaction)
-
-    elif node["module"] == "referrals" and (node["method"] == "reserve" or node["method"] == "unreserve"):
-        return process_refferals(context, node, transaction)
-    elif (node["module"] == "rewards" and node["method"] == "claim") or (
-            node["module"] == "pswapDistribution" and node["method"] == "claimIncentive") or (
-            node["module"] == "vestedRewards" and node["method"] == "claimRewards") or (
-            node["module"] == "vestedRewards" and node["method"] == "claimCrowdloanRewards"):
-
-        return process_reward(context, node, transaction)
+    values = dict()
+    for column in batch.columns:
+        if column in base:
+            node_values = base[column]
+            values[column] = [row[column] if column in row else node_values[i] for i, row in zip(origins, rows)]
+        else:
+            values[column] = [row.get(column, "") for row in rows]
 
-    return [transaction]
+    batch.extend_columns(values)
+
+
+def normalize_nodes(address, store, nodes):
+    """
+    Process worker entry point: normalizes nodes with a StoreSnapshot and returns the columns.
+    """
+    batch = RowBatch(columns)
+    normalize_page(Context(address, store), nodes, batch)
+    return batch.data
+
+
+def method_filter(module, method):
+    return {"module": {"equalTo": module}, "method": {"equalTo": method}}
+
+
+def batch_filter(*calls):
+    """
+    utility.batchAll extrinsics whose data contains any of the (module, method) calls.
+    """
+    return {"module": {"equalTo": "utility"}, "method": {"equalTo": "batchAll"},
+            "or": [{"data": {"contains": [{"module": module, "method": method}]}} for module, method in calls]}
+
+
+# transaction type -> (history element filters, whether the address may only appear as `to` in the data)
+transaction_types = {
+    "transfer": ([method_filter("assets", "transfer")], True),
+    "swap": ([method_filter("liquidityProxy", "swap"),
+              method_filter("liquidityProxy", "swapTransfer")], True),
+    "liquidity": ([{"module": {"equalTo": "utility"}, "method": {"equalTo": "batchAll"},
+                    "data": {"contains": [{"module": "poolXYK", "method": "initializePool"},
+                                          {"module": "poolXYK", "method": "depositLiquidity"}]}},
+                   {"module": {"includesInsensitive": "poolXYK"}, "method": {"equalTo": "depositLiquidity"}},
+                   {"module": {"includesInsensitive": "poolXYK"}, "method": {"equalTo": "withdrawLiquidity"}}], False),
+    "bridge": ([method_filter("ethBridge", "transferToSidechain")], False),
+    "register": ([method_filter("assets", "register")], False),
+    "referral": ([method_filter("referrals", "setReferrer"),
+                  method_filter("referrals", "reserve"),
+                  method_filter("referrals", "unreserve")], True),
+    "reward": ([method_filter("pswapDistribution", "claimIncentive"),
+                method_filter("rewards", "claim"),
+                method_filter("vestedRewards", "claimRewards"),
+                method_filter("vestedRewards", "claimCrowdloanRewards"),
+                batch_filter(("pswapDistribution", "claimIncentive"), ("rewards", "claim"),
+                             ("vestedRewards", "claimRewards"), ("vestedRewards", "claimCrowdloanRewards"))], False),
+}
 
 
-def sora_process(base_path, address, from_block, to_block):
-    if not ss58.is_valid_ss58_address(address):
-        raise ValueError(f"Address {address} is not valid ss58 address")
+def type_filter(transaction_type, addresses, from_block, to_block):
+    """
+    Filter of the history elements of one transaction type, with the jsonb `data contains`
+    address predicate only for the types that can have the address as a receiver in the data.
+    """
+    filters, incoming = transaction_types[transaction_type]
+    address_filter = {"address": {"in": addresses}}
+    if incoming:
+        address_filter = {"or": [address_filter] + [{"data": {"contains": {"to": address}}} for address in addresses]}
 
-    variables = {"filter": {
+    return {
         "and": [{"blockHeight": {"greaterThan": from_block}},
                 {"blockHeight": {"lessThan": to_block}},
-                {"or": [
-                    {"module": {"equalTo": "assets"}, "method": {"equalTo": "transfer"}},
-                    {"module": {"equalTo": "liquidityProxy"}, "method": {"equalTo": "swap"}},
-
-                    {"module": {"equalTo": "liquidityProxy"},
-                     "method": {"equalTo": "swapTransfer"}},
-
-                    {"module": {"equalTo": "utility"}, "method": {"equalTo": "batchAll"},
-                     "data": {"contains": [{"module": "poolXYK", "method": "initializePool"},
-                                           {"module": "poolXYK",
-                                            "method": "depositLiquidity"}]}},
-
-                    {"module": {"includesInsensitive": "poolXYK"},
-                     "method": {"equalTo": "depositLiquidity"}},
-                    {"module": {"includesInsensitive": "poolXYK"},
-                     "method": {"equalTo": "withdrawLiquidity"}},
-
-                    {"module": {"equalTo": "ethBridge"}, "method": {"equalTo": "transferToSidechain"}},
-
-                    {"module": {"equalTo": "assets"}, "method": {"equalTo": "register"}},
-
-                    {"module": {"equalTo": "referrals"}, "method": {"equalTo": "setReferrer"}},
-                    {"module": {"equalTo": "referrals"}, "method": {"equalTo": "reserve"}},
-                    {"module": {"equalTo": "referrals"}, "method": {"equalTo": "unreserve"}},
-
-                    {
-                        "or": [
-                            {"module": {"equalTo": "pswapDistribution"},
-                             "method": {"equalTo": "claimIncentive"}},
-                            {"module": {"equalTo": "rewards"},
-                             "method": {"equalTo": "claim"}},
-                            {"module": {"equalTo": "vestedRewards"},
-                             "method": {"equalTo": "claimRewards"}},
-                            {"module": {"equalTo": "vestedRewards"},
-                             "method": {"equalTo": "claimCrowdloanRewards"}},
-                            {"module": {"equalTo": "utility"},
-                             "method": {"equalTo": "batchAll"}, "or": [{"data": {
-                                "contains": [{"module": "pswapDistribution",
-                                              "method": "claimIncentive"}]}}, {"data": {
-                                "contains": [{"module": "rewards", "method": "claim"}]}}, {
-                                "data": {
-                                    "contains": [
-                                        {
-                                            "module": "vestedRewards",
-                                            "method": "claimRewards"}]}},
-                                {"data": {
-                                    "contains": [{
-                                        "module": "vestedRewards",
-                                        "method": "claimCrowdloanRewards"}]}}
-                            ]}
-                        ]}
-                ]},
-                {
-                    "or": [
-                        {"address": {"equalTo": address}},
-                        {"data": {"contains": {
-                            "to": address}}}]
-                }
-                ]
-    }}
-
-    columns = {"scan": "Scan Tool", "network": "Data Source", "timestamp": "Time Stamp", "date": "Date and Time (UTC)",
-               "height": "Block height", "tx_hash": "Transaction hash", "line": "Line Number",
-               "type": "Transaction Type", "amount": "Token amount", "ticker": "Token ticker",
-               "send_or_receive": "Sender or Receiver", "sender": "Sending wallet",
-               "receiver": "Receiving side address",
-               "network_fee": "Network fee amount", "fee_ticker": "Network fee token ticker",
-               "lp_fee": "Liquidity Provider Fee",
-               "lp_fee_ticker": "Liquidity Provider Fee token ticker"}
-
-    transaction_template = dict.fromkeys(columns.keys(), "")
-
-    transactions = pd.DataFrame()
-
-    context = Context(address)
-
-    while True:
-        page_transactions = pd.DataFrame()
-        result = client.execute(query, variable_values=variables)
-
-        elements = result["historyElements"]
-        page_info = elements["pageInfo"]
-        edges = elements["edges"]
-        i = 0
-        for edge in edges:
-            node = edge["node"]
-            i += 1
-            transaction = transaction_template.copy()
-            transaction["scan"] = "SubQuery"
-            transaction["network"] = "SORA Main Net"
-            transaction["timestamp"] = node["timestamp"]
-            transaction["date"] = datetime.utcfromtimestamp(node["timestamp"]).strftime('%Y-%m-%d %H:%M:%S')
-            transaction["height"] = node["blockHeight"]
-            transaction["tx_hash"] = node["id"]
-            transaction["line"] = 1
-            transaction["network_fee"] = node["networkFee"]
-            transaction["fee_ticker"] = "XOR"
-
-            new_transactions = process_module(context, node, transaction)
-
-            for elem in new_transactions:
-                page_transactions = page_transactions.append(elem, ignore_index=True)
-
-        transactions = pd.concat([transactions, page_transactions])
-        variables["after"] = page_info["endCursor"]
-        if not page_info["hasNextPage"]:
-            break
-
-    if transactions.empty:
-        return
+                filters[0] if len(filters) == 1 else {"or": filters},
+                address_filter]
+    }
+
+
+def plan_queries(types, addresses):
+    """
+    Returns one filter factory (from_block, to_block) -> filter per wanted transaction type.
+    """
+    types = list(transaction_types) if types is None else types
+    if len(types) == 0:
+        raise ValueError(f"No transaction types to fetch, leave types out to fetch all of "
+                         f"{', '.join(transaction_types)}")
+    for transaction_type in types:
+        if transaction_type not in transaction_types:
+            raise ValueError(f"Unknown transaction type {transaction_type}, "
+                             f"expected one of {', '.join(transaction_types)}")
+
+    return [lambda low, high, t=transaction_type: type_filter(t, addresses, low, high)
+            for transaction_type in dict.fromkeys(types)]
+
+
+def checkpoint_types(types):
+    """
+    Types as kept in checkpoints: sorted without duplicates, None when all of them are fetched.
+    """
+    if types is None or set(types) == set(transaction_types):
+        return None
+    return sorted(set(types))
+
 
-    to_block = transactions.head(1)["height"].values[0]
-    stime = datetime.now().strftime("%H:%M %d.%m.%y")
-    name = f"SORA {stime} {address[:4]}...{address[-4:]} ({from_block}:{to_block}]"
-    filepath = os.path.join(base_path, f"{name}.csv")
-    transactions.rename(columns=columns).to_csv(filepath)
+def node_addresses(node, addresses):
+    owners = []
+    if node["address"] in addresses:
+        owners.append(node["address"])
+
+    data = node["data"]
+    if isinstance(data, dict) and data.get("to") in addresses and data["to"] not in owners:
+        owners.append(data["to"])
+
+    return owners
+
+
+class AddressReport:
+    """
+    Report, local store and checkpoint of one address of a (possibly shared) history scan.
+    """
+
+    def __init__(self, base_path, address, from_block, to_block, incremental, store, types=None):
+        self.context = Context(address, store)
+        # also kept without incremental, for the partial report of a failed scan
+        self.checkpoint = Checkpoint(base_path, "sora", address, from_block, types)
+        self.incremental = incremental
+        self.start_block = from_block
+        if incremental and self.checkpoint.block is not None:
+            self.start_block = self.checkpoint.block
+        # to_block is exclusive
+        self.last_block = to_block - 1
+        self.partial = self.checkpoint.resume(self.start_block, self.last_block)
+
+        self.batch = RowBatch(columns)
+        self.db = open_store("sora", address)
+
+        previous = self.checkpoint.report if incremental else None
+        self.writer = ReportWriter(base_path, "SORA", address, from_block, previous, partial=self.partial)
+
+    def select(self, nodes):
+        return [node for node in nodes if int(node["blockHeight"]) > self.start_block]
+
+    def write(self, nodes):
+        with metrics.timer("normalize"):
+            normalize_page(self.context, self.select(nodes), self.batch)
+        self.flush()
+
+    def write_columns(self, values: dict):
+        self.batch.extend_columns(values)
+        self.flush()
+
+    def flush(self):
+        self.writer.write(self.batch)
+        if self.db is not None:
+            self.db.write(self.batch)
+        self.batch.clear()
+
+    def close(self, scanned=None):
+        """
+        Closes the report, `scanned` is the last block of a finalized range, checkpointed also without rows.
+        """
+        self.writer.close()
+        if self.db is not None:
+            self.db.close()
+
+        # a head behind the checkpoint does not move it back
+        block = max(scanned, self.start_block) if scanned is not None else self.writer.to_block
+        if self.incremental and block is not None:
+            self.checkpoint.save(block, self.writer.path)
+        else:
+            self.checkpoint.clear_partial()
+
+    def abort(self):
+        partial = self.writer.abort(keep=True)
+        if partial is not None:
+            self.checkpoint.save_partial(partial, self.start_block, self.last_block)
+        if self.db is not None:
+            self.db.close()
+
+
+def scan_ranges(reports, from_block, to_block):
+    """
+    The (from, to) ranges of a scan from from_block to to_block that are not covered by the
+    partial reports of all reports, newest first.
+    """
+    partials = [report.partial for report in reports]
+    if any(partial is None for partial in partials):
+        return [(from_block, to_block)]
+    low = max(partial["block"] for partial in partials)
+    high = min(partial["to-block"] for partial in partials)
+    if low >= high:
+        return [(from_block, to_block)]
+    return [(high, to_block), (from_block, low + 1)]
+
+
+def fetch_ranges(make_filters, ranges):
+    for from_block, to_block in ranges:
+        yield from subquery.fetch_merged(query, make_filters, from_block, to_block)
+
+
+def write_normalized(reports):
+    for report, future in reports:
+        with metrics.timer("normalize.wait"):
+            values = future.result()
+        report.write_columns(values)
+
+
+def sora_process_many(base_path, addresses, from_block, to_block, incremental=False, types=None, finalized=False):
+    """
+    Scans the history of all addresses with one query per transaction type and splits the rows into
+    a report per address. An element that involves several of the addresses goes to each of their reports.
+    With `finalized`, every block below to_block is final and indexed, the checkpoints move past them.
+    """
+    for address in addresses:
+        if not ss58.is_valid_ss58_address(address):
+            raise ValueError(f"Address {address} is not valid ss58 address")
+
+    make_filters = plan_queries(types, addresses)
+
+    store = shared_store()
+    executor = get_executor()
+    # pages sent to the normalization workers, written back in order
+    pending = deque()
+    reports = dict()
+    try:
+        for address in addresses:
+            reports[address] = AddressReport(base_path, address, from_block, to_block, incremental, store,
+                                             checkpoint_types(types))
+
+        start_block = min(report.start_block for report in reports.values())
+        for nodes in fetch_ranges(make_filters, scan_ranges(reports.values(), start_block, to_block)):
+            asset_ids = collect_asset_ids([node["data"] for node in nodes], set())
+            store.prefetch(asset_ids)
+            registered = {(node["data"]["assetId"], node.get("blockHash")) for node in nodes
+                          if node["module"] == "assets" and node["method"] == "register"}
+            store.prefetch_supplies(registered)
+
+            address_nodes = {address: [] for address in reports}
+            for node in nodes:
+                for address in node_addresses(node, reports):
+                    address_nodes[address].append(node)
+
+            if executor is None:
+                for address, report in reports.items():
+                    report.write(address_nodes[address])
+                continue
+
+            snapshot = store.snapshot(asset_ids, registered)
+            pending.append([(report, executor.submit(normalize_nodes, address, snapshot,
+                                                     report.select(address_nodes[address])))
+                            for address, report in reports.items()])
+            while len(pending) > settings["normalize-workers"]:
+                write_normalized(pending.popleft())
+
+        while pending:
+            write_normalized(pending.popleft())
+    except BaseException:
+        for report in reports.values():
+            report.abort()
+        raise
+
+    for report in reports.values():
+        # to_block is exclusive
+        report.close(to_block - 1 if finalized else None)
+
+
+def sora_process(base_path, address, from_block, to_block, incremental=False, types=None, finalized=False):
+    sora_process_many(base_path, [address], from_block, to_block, incremental, types, finalized)
@@ -0,0 +1,451 @@
+import gql
+from gql.transport.aiohttp import AIOHTTPTransport
+from graphql import build_client_schema, get_introspection_query, print_ast, validate
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from utils import metrics
+from utils.files import write_json
+from utils.http_cache import cached
+from utils.ratelimit import limit
+import asyncio
+import atexit
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+
+settings = {
+    "url": "https://api.subquery.network/sq/sora-xor/sora-prod-sub4",
+    # max in-flight requests to the endpoint per scan, shared by the transaction type queries
+    "concurrency": 4,
+    # pages fetched ahead of the consumer by each shard and each transaction type query
+    "read-ahead": 2,
+    # a block range with more history elements than this is split in two
+    "shard-size": 5000,
+    # directory of the introspected schemas, one file per url
+    "schema-cache": os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "sorascan"),
+    # seconds before the schema is introspected again
+    "schema-ttl": 7 * 24 * 60 * 60,
+    # seconds to wait for a response
+    "timeout": 120,
+    # history elements per page, None keeps the server default
+    "page-size": None,
+    # grow pages while responses are fast and small, shrink them on slow, oversized or timed out ones
+    "adaptive-page-size": False,
+    "min-page-size": 10,
+    "max-page-size": 1000,
+    "target-latency": 2.0,
+    "max-page-bytes": 2 * 1024 * 1024,
+}
+
+_loop = None
+_session = None
+_session_lock = threading.Lock()
+_schema = dict()
+_schema_lock = threading.Lock()
+# texts of the queries already validated against the schema
+_validated = set()
+
+
+def configure(endpoints: dict):
+    settings.update(endpoints.get("subquery", {}))
+
+
+def _schema_path(url):
+    name = "schema-{}.json".format(sha256(url.encode()).hexdigest()[:16])
+    return os.path.join(os.path.expanduser(settings["schema-cache"]), name)
+
+
+def _introspection_hash(introspection):
+    return sha256(json.dumps(introspection, sort_keys=True).encode()).hexdigest()
+
+
+def _load_schema(path):
+    """
+    Returns (introspection, fetched time) of the schema file, or None when it is missing or
+    its content does not match the saved hash.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    introspection = data.get("introspection")
+    if introspection is None or data.get("sha256") != _introspection_hash(introspection):
+        print("WARN: Ignoring corrupted schema cache {}".format(path))
+        return None
+
+    return introspection, data.get("fetched", 0)
+
+
+def _save_schema(path, introspection):
+    data = {"url": settings["url"], "fetched": time.time(), "sha256": _introspection_hash(introspection),
+            "introspection": introspection}
+
+    try:
+        write_json(path, data)
+    except OSError as e:
+        print("WARN: Cannot save schema cache {}: {}".format(path, e))
+
+
+def _introspect(url):
+    client = gql.Client(transport=AIOHTTPTransport(url=url), execute_timeout=None)
+    with limit("subquery"):
+        return client.execute(gql.gql(get_introspection_query()))
+
+
+def get_schema():
+    """
+    Returns the schema of the endpoint, introspected at most once per `schema-ttl` and kept on disk
+    between runs. A stale schema is still used when the endpoint cannot be reached, None is returned
+    when there is no schema at all.
+    """
+    url = settings["url"]
+    with _schema_lock:
+        if url in _schema:
+            return _schema[url]
+
+        path = _schema_path(url)
+        saved = _load_schema(path)
+        introspection = None
+        if saved is not None:
+            introspection, fetched = saved
+            if time.time() - fetched >= settings["schema-ttl"]:
+                saved = None
+
+        if saved is None:
+            try:
+                introspection = _introspect(url)
+                _save_schema(path, introspection)
+            except Exception as e:
+                print("WARN: Cannot introspect the schema of {}: {!r}".format(url, e))
+
+        _schema[url] = build_client_schema(introspection) if introspection is not None else None
+        return _schema[url]
+
+
+def get_session():
+    """
+    Returns the event loop running on a background thread and the gql session connected on it.
+    All threads share the session, so its keep-alive connections are reused by every request.
+    """
+    global _loop, _session
+    with _session_lock:
+        if _session is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="subquery", daemon=True).start()
+
+            schema = get_schema()
+            client = gql.Client(transport=AIOHTTPTransport(url=settings["url"]), schema=schema,
+                                fetch_schema_from_transport=schema is None, execute_timeout=None)
+            _session = asyncio.run_coroutine_threadsafe(client.connect_async(), loop).result()
+            _loop = loop
+        return _loop, _session
+
+
+@atexit.register
+def close_session():
+    global _loop, _session
+    with _session_lock:
+        if _session is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(_session.client.close_async(), _loop).result()
+        _loop.call_soon_threadsafe(_loop.stop)
+        _loop, _session = None, None
+
+
+def _fetch(query, variables):
+    loop, session = get_session()
+    request = asyncio.wait_for(session.execute(query, variable_values=variables), settings["timeout"])
+    with limit("subquery"), metrics.timer("subquery.request"):
+        result = asyncio.run_coroutine_threadsafe(request, loop).result()
+    if metrics.active():
+        metrics.count("subquery.bytes", len(json.dumps(result)))
+    return result
+
+
+def check_query(query, text):
+    """
+    Validates the query against the cached schema once, also when its responses are replayed
+    from the http cache and no request is made.
+    """
+    if text in _validated:
+        return
+
+    schema = get_schema()
+    if schema is not None:
+        errors = validate(schema, query)
+        if errors:
+            raise errors[0]
+    _validated.add(text)
+
+
+def execute(query, variables, cache_variables=None):
+    """
+    Runs the query, through the http cache keyed by `cache_variables` (the variables by default).
+    """
+    text = print_ast(query)
+    check_query(query, text)
+    key = variables if cache_variables is None else cache_variables
+    return cached(settings["url"], text, key, lambda: _fetch(query, variables))
+
+
+metadata_query = gql.gql("""
+query {
+    _metadata {
+        lastProcessedHeight
+    }
+}
+""")
+
+
+def indexed_height():
+    """
+    Height of the last block processed by the indexer. Never read from the http cache.
+    """
+    check_query(metadata_query, print_ast(metadata_query))
+    return int(_fetch(metadata_query, {})["_metadata"]["lastProcessedHeight"])
+
+
+def count_elements(query, make_filter, from_block, to_block):
+    # totalCount is an expensive count on the server, pages do not request it
+    variables = {"filter": make_filter(from_block, to_block), "first": 1, "withCount": True}
+    result = execute(query, variables)
+    return result["historyElements"]["totalCount"]
+
+
+class PageSize:
+    """
+    Page size of one shard scan. When adaptive, it doubles after a response that took less than
+    half the target latency and half the byte limit, and halves after a response over either limit
+    or a timeout.
+    """
+
+    def __init__(self):
+        self.adaptive = settings["adaptive-page-size"]
+        self.size = settings["page-size"]
+        if self.adaptive and self.size is None:
+            self.size = 100
+
+    def update(self, seconds, result):
+        if not self.adaptive:
+            return
+
+        size = len(json.dumps(result))
+        if seconds > settings["target-latency"] or size > settings["max-page-bytes"]:
+            self.size = max(self.size // 2, settings["min-page-size"])
+        elif seconds < settings["target-latency"] / 2 and size < settings["max-page-bytes"] / 2:
+            self.size = min(self.size * 2, settings["max-page-size"])
+
+    def shrink(self):
+        """
+        Halves the page size after a timeout, returns False when it cannot get smaller.
+        """
+        if not self.adaptive or self.size <= settings["min-page-size"]:
+            return False
+        self.size = max(self.size // 2, settings["min-page-size"])
+        return True
+
+
+def fetch_page(query, variables, page_size: PageSize):
+    """
+    Fetches one page. Adaptive page sizes depend on response times, so they are left out of the
+    http cache key: a replay follows the recorded pages through their cursors, whatever their size.
+    """
+    while True:
+        if page_size.size is not None:
+            variables["first"] = page_size.size
+
+        cache_variables = None
+        if page_size.adaptive:
+            cache_variables = {name: value for name, value in variables.items() if name != "first"}
+
+        start = time.monotonic()
+        try:
+            result = execute(query, variables, cache_variables)
+        except asyncio.TimeoutError:
+            if page_size.shrink():
+                continue
+            raise
+
+        page_size.update(time.monotonic() - start, result)
+        return result
+
+
+def _put(pages: queue.Queue, item, stop: threading.Event):
+    """
+    Puts item into the bounded queue, returns False without putting it once the consumer stopped.
+    """
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def fetch_shard(query, make_filter, from_block, to_block, pages: queue.Queue, stop: threading.Event,
+                slots: threading.Semaphore):
+    """
+    Puts the pages of the shard into `pages` as they arrive, then None. The next page is requested
+    as soon as the cursor of the previous one is known, while the consumer processes it, until
+    `read-ahead` pages wait in the queue. Every request holds one of the scan's `slots`.
+    """
+    variables = {"filter": make_filter(from_block, to_block)}
+    page_size = PageSize()
+    try:
+        while not stop.is_set():
+            with slots:
+                result = fetch_page(query, variables, page_size)
+
+            elements = result["historyElements"]
+            page_info = elements["pageInfo"]
+            if not _put(pages, [edge["node"] for edge in elements["edges"]], stop):
+                return
+
+            variables["after"] = page_info["endCursor"]
+            if not page_info["hasNextPage"]:
+                break
+    except BaseException as e:
+        _put(pages, e, stop)
+        return
+
+    _put(pages, None, stop)
+
+
+def _drain(pages: queue.Queue):
+    while True:
+        page = pages.get()
+        if page is None:
+            return
+        if isinstance(page, BaseException):
+            raise page
+        yield page
+
+
+def plan_shards(executor, query, make_filter, from_block, to_block, slots: threading.Semaphore):
+    """
+    Splits the (from_block, to_block) range in halves until every shard holds at most
+    `shard-size` history elements. Empty shards are dropped. Shards are returned from the
+    highest block to the lowest, matching the TIMESTAMP_DESC order of the query.
+    """
+    shards = []
+    ranges = [(from_block, to_block)]
+    while ranges:
+        def count(r):
+            with slots:
+                return count_elements(query, make_filter, *r)
+
+        counts = executor.map(metrics.propagate(count), ranges)
+
+        next_ranges = []
+        for (low, high), total in zip(ranges, counts):
+            if total == 0:
+                continue
+
+            if total > settings["shard-size"] and high - low >= 3:
+                # blocks are filtered with greaterThan/lessThan, so both halves are open intervals
+                middle = (low + high + 1) // 2
+                next_ranges.append((low, middle))
+                next_ranges.append((middle - 1, high))
+            else:
+                shards.append((low, high))
+
+        ranges = next_ranges
+
+    shards.sort(reverse=True)
+    return shards
+
+
+def fetch_pages(query, make_filter, from_block, to_block, slots=None):
+    """
+    Yields pages of history element nodes between from_block and to_block (exclusive) in
+    TIMESTAMP_DESC order. Shards are fetched concurrently, at most `concurrency` of them ahead
+    of the consumer, and their pages are yielded as soon as they arrive. At most `concurrency`
+    requests are in flight, `slots` shares that limit with other scans.
+    """
+    concurrency = settings["concurrency"]
+    if slots is None:
+        slots = threading.BoundedSemaphore(concurrency)
+    stop = threading.Event()
+    with ThreadPoolExecutor(concurrency) as executor:
+        try:
+            shards = plan_shards(executor, query, make_filter, from_block, to_block, slots)
+
+            pending = deque()
+            for low, high in shards:
+                pages = queue.Queue(maxsize=settings["read-ahead"])
+                executor.submit(metrics.propagate(fetch_shard), query, make_filter, low, high, pages, stop, slots)
+                pending.append(pages)
+                if len(pending) >= concurrency:
+                    yield from _drain(pending.popleft())
+
+            while pending:
+                yield from _drain(pending.popleft())
+        finally:
+            # shards still being fetched stop after their current page when the consumer gives up
+            stop.set()
+
+
+def _stream(generator, pages: queue.Queue, stop: threading.Event):
+    try:
+        for page in generator:
+            if not _put(pages, page, stop):
+                return
+    except BaseException as e:
+        _put(pages, e, stop)
+        return
+    finally:
+        generator.close()
+
+    _put(pages, None, stop)
+
+
+def fetch_merged(query, make_filters, from_block, to_block):
+    """
+    Runs fetch_pages for every filter concurrently and merges their nodes in TIMESTAMP_DESC order.
+    A node matched by several filters is yielded once. Yields pages of `page-size` nodes
+    (100 by default). Each filter buffers at most `read-ahead` pages, and all of them share
+    the `concurrency` in-flight requests of the scan.
+    """
+    if len(make_filters) == 1:
+        yield from fetch_pages(query, make_filters[0], from_block, to_block)
+        return
+
+    page_size = settings["page-size"] or 100
+    slots = threading.BoundedSemaphore(settings["concurrency"])
+    stop = threading.Event()
+    with ThreadPoolExecutor(len(make_filters)) as executor:
+        try:
+            streams = []
+            for make_filter in make_filters:
+                pages = queue.Queue(maxsize=settings["read-ahead"])
+                executor.submit(metrics.propagate(_stream),
+                                fetch_pages(query, make_filter, from_block, to_block, slots), pages, stop)
+                streams.append(node for page in _drain(pages) for node in page)
+
+            page = []
+            # ids of the nodes with the last timestamp, duplicates have the same timestamp
+            timestamp, ids = None, set()
+            for node in heapq.merge(*streams, key=lambda node: -int(node["timestamp"])):
+                if node["timestamp"] != timestamp:
+                    timestamp, ids = node["timestamp"], set()
+                if node["id"] in ids:
+                    continue
+                ids.add(node["id"])
+
+                page.append(node)
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+
+            if len(page) > 0:
+                yield page
+        finally:
+            stop.set()
@@ -0,0 +1,119 @@
+from dotenv import dotenv_values
+from models import store
+from networks import subquery
+from networks.etherscan_client import EtherscanClient
+from utils.scheduler import Job, Scheduler, retryable_errors
+import asyncio
+import json
+import threading
+import time
+from websocket import create_connection
+
+settings = {
+    # seconds between Etherscan head polls, and before reconnecting when no SORA host answers
+    "poll-interval": 30,
+    # Ethereum blocks below the head that are considered final
+    "confirmations": 12,
+    # seconds without a SORA head notification before the subscription is reconnected
+    "head-timeout": 60,
+}
+
+
+def configure(options: dict):
+    settings.update(options)
+
+
+def sora_heads():
+    """
+    Yields the heights of new finalized SORA blocks that are indexed by SubQuery, from a
+    chain_subscribeFinalizedHeads subscription on the sora-rpc hosts.
+    """
+    while True:
+        for url in store.settings["hosts"]:
+            ws = None
+            try:
+                ws = create_connection(url, timeout=store.settings["timeout"])
+                ws.send(json.dumps({"id": 1, "jsonrpc": "2.0", "method": "chain_subscribeFinalizedHeads",
+                                    "params": []}))
+                ws.settimeout(settings["head-timeout"])
+                while True:
+                    message = json.loads(ws.recv())
+                    if message.get("method") != "chain_finalizedHead":
+                        continue
+                    head = int(message["params"]["result"]["number"], 16)
+                    # the indexer follows the chain with a delay, its blocks are not complete yet
+                    yield min(head, subquery.indexed_height())
+            except retryable_errors as e:
+                print("WARN: SORA head subscription on {} failed: {!r}".format(url, e))
+            finally:
+                if ws is not None:
+                    ws.close()
+        time.sleep(settings["poll-interval"])
+
+
+def ethereum_heads():
+    """
+    Yields the height of the Ethereum head minus `confirmations` every `poll-interval` seconds.
+    """
+    config = dotenv_values(".env")
+    client = EtherscanClient(config["ETHERSCAN_KEY"])
+    while True:
+        try:
+            yield client.get_block_number() - settings["confirmations"]
+        except retryable_errors as e:
+            print("WARN: Ethereum head poll failed: {!r}".format(e))
+        time.sleep(settings["poll-interval"])
+
+
+heads = {"sora": sora_heads, "ethereum": ethereum_heads}
+
+# to_block of a scan up to a head, exclusive on SORA and inclusive on Ethereum
+scan_end = {"sora": 1, "ethereum": 0}
+
+
+async def follow(network, jobs: list):
+    """
+    Runs the jobs of network up to every new head. Heads arriving while the jobs run are
+    coalesced into the newest one, so a slow scan catches up in one step.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def feed():
+        try:
+            for head in heads[network]():
+                loop.call_soon_threadsafe(queue.put_nowait, head)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    last = None
+    while True:
+        head = await queue.get()
+        while not queue.empty():
+            head = queue.get_nowait()
+        if isinstance(head, Exception):
+            raise head
+        if last is not None and head <= last:
+            continue
+
+        start = time.monotonic()
+        # incremental scans of the finalized range past the checkpoints, to-block is ignored
+        tick = [Job(job.name, job.fn, job.args[:3] + (head + scan_end[network], True) + job.args[5:] + (True,))
+                for job in jobs]
+        failed = await Scheduler(tick, quiet=True).run()
+        print("{} block {}: {} jobs, {} failed, in {:.1f}s".format(network, head, len(tick), len(failed),
+                                                                  time.monotonic() - start))
+        last = head
+
+
+async def watch(jobs: list):
+    """
+    Follows the chains of the (network, job) pairs until interrupted. Jobs take the arguments of
+    sora_process, sora_process_many and eth_process, which are rerun for the new blocks only.
+    """
+    networks = dict()
+    for network, job in jobs:
+        networks.setdefault(network, []).append(job)
+    await asyncio.gather(*(follow(network, network_jobs) for network, network_jobs in networks.items()))
@@ -0,0 +1,48 @@
+import argparse
+import os
+
+from models.db import TransactionDB
+from models.report import ReportWriter, sinks
+
+report_names = {
+    "sora": "SORA",
+    "ethereum": "ETH"
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate a report from the local transaction store")
+
+    parser.add_argument('db_path',
+                        help='SQLite database set as "store" in the config')
+    parser.add_argument('network', choices=report_names.keys(),
+                        help='network option of the address')
+    parser.add_argument('address',
+                        help='address to build the report for')
+    parser.add_argument('--from-block', type=int, default=0,
+                        help='first block of the report, exclusive')
+    parser.add_argument('--to-block', type=int, default=None,
+                        help='last block of the report, inclusive')
+    parser.add_argument('--type', action='append', dest='types',
+                        help='transaction type to include, can be repeated')
+    parser.add_argument('--output', default=os.getcwd(),
+                        help='directory to write the report to')
+    parser.add_argument('--format', choices=sinks.keys(), default="csv",
+                        help='report format')
+
+    args = parser.parse_args()
+
+    with TransactionDB(args.db_path) as db:
+        with ReportWriter(args.output, report_names[args.network], args.address, args.from_block,
+                          format=args.format) as writer:
+            for batch in db.query(args.network, args.address, args.from_block, args.to_block, args.types):
+                writer.write(batch)
+
+    if writer.path is None:
+        print("WARN: No transactions found for {} in {}".format(args.address, args.db_path))
+    else:
+        print(writer.path)
+
+
+if __name__ == '__main__':
+    main()
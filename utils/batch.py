@@ -0,0 +1,49 @@
+import pandas as pd
+
+
+class RowBatch:
+    """
+    Column-oriented row buffer. Rows are appended to one list per column and the
+    DataFrame is built once, instead of copying a growing frame for every row.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.data = {column: [] for column in self.columns}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row: dict):
+        for column in self.columns:
+            self.data[column].append(row.get(column, ""))
+        self.size += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def extend_columns(self, values: dict):
+        for column in self.columns:
+            self.data[column].extend(values[column])
+        self.size = len(self.data[self.columns[0]])
+
+    def first(self, column):
+        return self.data[column][0]
+
+    def last(self, column):
+        return self.data[column][-1]
+
+    def slice(self, start, stop=None):
+        batch = RowBatch(self.columns)
+        batch.extend_columns({column: values[start:stop] for column, values in self.data.items()})
+        return batch
+
+    def clear(self):
+        for values in self.data.values():
+            values.clear()
+        self.size = 0
+
+    def to_frame(self):
+        return pd.DataFrame(self.data, columns=self.columns)
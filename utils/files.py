@@ -0,0 +1,20 @@
+import json
+import os
+import tempfile
+
+
+def write_json(path, data):
+    """
+    Writes data as JSON to a temporary file next to path and renames it over path, so readers
+    see either the old or the new content. The temporary file is removed when the write fails.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
@@ -0,0 +1,57 @@
+from hashlib import sha256
+from utils import metrics
+from utils.files import write_json
+import json
+import os
+
+settings = {
+    # off: always fetch, record: fetch and save, replay: only read saved responses,
+    # read-through: read saved responses and fetch (and save) the missing ones
+    "mode": "off",
+    "path": os.path.join(".sorascan", "responses"),
+}
+
+modes = ("off", "record", "replay", "read-through")
+
+
+def configure(options: dict):
+    settings.update(options)
+    if settings["mode"] not in modes:
+        raise ValueError(f"Unknown http cache mode {settings['mode']}, expected one of {', '.join(modes)}")
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def response_key(endpoint: str, query: str, variables: dict):
+    data = json.dumps([endpoint, query, variables], sort_keys=True, default=str)
+    return sha256(data.encode()).hexdigest()
+
+
+def cached(endpoint: str, query: str, variables: dict, fetch):
+    """
+    Returns the response of `fetch()` for the (endpoint, query, variables) request,
+    reading and saving it according to the cache mode. Responses must be JSON serializable.
+    """
+    mode = settings["mode"]
+    if mode == "off":
+        return fetch()
+
+    key = response_key(endpoint, query, variables)
+    path = os.path.join(os.path.expanduser(settings["path"]), key[:2], f"{key}.json")
+
+    if mode in ("replay", "read-through"):
+        try:
+            with open(path) as f:
+                response = json.load(f)
+            metrics.count("http-cache.hits")
+            return response
+        except (OSError, ValueError):
+            metrics.count("http-cache.misses")
+            if mode == "replay":
+                raise CacheMiss(f"No recorded response for {endpoint} {variables}")
+
+    response = fetch()
+    write_json(path, response)
+    return response
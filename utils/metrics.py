@@ -0,0 +1,180 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import json
+import threading
+import time
+
+# upper bounds in seconds of the stage latency histograms
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+# (hit counter, miss counter) of the caches whose hit ratio is reported
+caches = {"asset-cache": ("asset-cache.hits", "asset-cache.misses"),
+          "http-cache": ("http-cache.hits", "http-cache.misses"),
+          "supply-cache": ("supply-cache.hits", "supply-cache.misses")}
+
+# metrics of the job running in the current context, None when profiling is off
+_job = ContextVar("metrics_job", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class JobMetrics:
+    """
+    Stage timings and counters of one job, shared by all the threads working for it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.monotonic()
+        self.seconds = None
+        self.stages = dict()
+        self.counters = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.start
+
+    def summary(self):
+        seconds = self.seconds if self.seconds is not None else time.monotonic() - self.start
+        rows = self.counters.get("rows", 0)
+        result = {"job": self.name, "seconds": round(seconds, 3), "rows": rows,
+                  "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else 0,
+                  "stages": {stage: {"count": h.count, "seconds": round(h.sum, 3),
+                                     "p50": round(h.quantile(0.5), 4), "p95": round(h.quantile(0.95), 4),
+                                     "max": round(h.max, 4)}
+                             for stage, h in sorted(self.stages.items())},
+                  "counters": dict(sorted(self.counters.items())),
+                  "cache_hit_ratio": dict()}
+        for cache, (hits, misses) in caches.items():
+            total = self.counters.get(hits, 0) + self.counters.get(misses, 0)
+            if total > 0:
+                result["cache_hit_ratio"][cache] = round(self.counters.get(hits, 0) / total, 4)
+        return result
+
+
+def begin(name):
+    """
+    Starts collecting the metrics of a job in the current context, returns them.
+    """
+    metrics = JobMetrics(name)
+    _job.set(metrics)
+    return metrics
+
+
+def active():
+    return _job.get() is not None
+
+
+def count(name, value=1):
+    metrics = _job.get()
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+@contextmanager
+def timer(stage):
+    metrics = _job.get()
+    if metrics is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(stage, time.perf_counter() - start)
+
+
+def propagate(fn):
+    """
+    Returns fn running with the metrics of the calling job, for functions submitted to executor
+    threads, which do not inherit the context of the submitting thread.
+    """
+    metrics = _job.get()
+    if metrics is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _job.set(metrics)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _job.reset(token)
+
+    return run
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def write_prometheus(path, jobs):
+    """
+    Writes the metrics of the jobs in the Prometheus text exposition format.
+    """
+    lines = ["# HELP sorascan_stage_seconds Duration of the processing stages.",
+             "# TYPE sorascan_stage_seconds histogram"]
+    for job in jobs:
+        for stage, h in sorted(job.stages.items()):
+            labels = 'job="{}",stage="{}"'.format(_label(job.name), _label(stage))
+            seen = 0
+            for bound, count in zip(buckets, h.counts):
+                seen += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('sorascan_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, seen))
+            lines.append("sorascan_stage_seconds_sum{{{}}} {}".format(labels, h.sum))
+            lines.append("sorascan_stage_seconds_count{{{}}} {}".format(labels, h.count))
+
+    lines += ["# HELP sorascan_events_total Rows, bytes, cache lookups and retries of the jobs.",
+              "# TYPE sorascan_events_total counter"]
+    for job in jobs:
+        for name, value in sorted(job.counters.items()):
+            lines.append('sorascan_events_total{{job="{}",name="{}"}} {}'.format(_label(job.name), _label(name), value))
+
+    lines += ["# HELP sorascan_job_seconds Duration of the jobs.",
+              "# TYPE sorascan_job_seconds gauge"]
+    for job in jobs:
+        lines.append('sorascan_job_seconds{{job="{}"}} {}'.format(_label(job.name), job.summary()["seconds"]))
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_summary(path, jobs):
+    with open(path, "w") as f:
+        json.dump([job.summary() for job in jobs], f, indent=2)
@@ -1,8 +1,84 @@
+class Amount:
+    """
+    Exact token amount: an integer number of base units and the precision (decimals) of the token.
+    Amounts are only turned into decimal strings when a report is written.
+    """
 
-def set_precision(s, pr):
-    assert (pr >= 0)
-    if len(s) > pr:
-        diff = len(s) - pr
-        return s[:diff] + "." + s[diff:]
+    __slots__ = ("value", "precision")
+
+    def __init__(self, value: int, precision: int):
+        assert (precision >= 0)
+        self.value = value
+        self.precision = precision
+
+    @classmethod
+    def parse(cls, s):
+        """
+        Parses a decimal string such as "12.3400" keeping its number of fractional digits,
+        so the amount is printed back exactly as received. Other values are returned as is.
+        """
+        if not isinstance(s, str):
+            return s
+
+        whole, _, fraction = s.partition(".")
+        digits = whole + fraction
+        if not digits.isdigit():
+            return s
+
+        return cls(int(digits), len(fraction))
+
+    def rescale(self, precision: int):
+        assert (precision >= self.precision)
+        return Amount(self.value * 10 ** (precision - self.precision), precision)
+
+    def __add__(self, other):
+        if not isinstance(other, Amount):
+            return NotImplemented
+        precision = max(self.precision, other.precision)
+        return Amount(self.rescale(precision).value + other.rescale(precision).value, precision)
+
+    def __eq__(self, other):
+        if not isinstance(other, Amount):
+            return NotImplemented
+        precision = max(self.precision, other.precision)
+        return self.rescale(precision).value == other.rescale(precision).value
+
+    def __hash__(self):
+        value, precision = self.value, self.precision
+        while precision > 0 and value % 10 == 0:
+            value //= 10
+            precision -= 1
+        return hash((value, precision))
+
+    def __repr__(self):
+        return f"Amount({self.value}, {self.precision})"
+
+    def __str__(self):
+        return _format(self.value, self.precision, 10 ** self.precision)
+
+
+def _format(value, precision, scale):
+    if value < 0:
+        return "-" + _format(-value, precision, scale)
+    if precision == 0:
+        return str(value)
+    whole, fraction = divmod(value, scale)
+    return f"{whole}.{fraction:0{precision}d}"
+
+
+def format_amounts(values):
+    """
+    Converts a column of amounts to decimal strings, values that are not an Amount are kept.
+    """
+    scales = dict()
+    result = []
+    for value in values:
+        if isinstance(value, Amount):
+            scale = scales.get(value.precision)
+            if scale is None:
+                scale = scales[value.precision] = 10 ** value.precision
+            result.append(_format(value.value, value.precision, scale))
+        else:
+            result.append(value)
+    return result
 
-    return "0." + "0" * (pr - len(s)) + s
\ No newline at end of file
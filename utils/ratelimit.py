@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+import threading
+import time
+
+defaults = {
+    # free Etherscan API keys are limited to 5 calls per second
+    "etherscan": {"rate": 5},
+}
+
+# endpoint name -> options, see configure
+settings = {name: dict(options) for name, options in defaults.items()}
+
+_limits = dict()
+_lock = threading.Lock()
+
+
+def configure(endpoints: dict):
+    """
+    Reads `rate` (requests per second), `burst` and `max-in-flight` of every endpoint.
+    SORA RPC limits apply to each host separately.
+    """
+    settings.clear()
+    _limits.clear()
+    for name in set(defaults) | set(endpoints):
+        options = {**defaults.get(name, {}), **endpoints.get(name, {})}
+        if any(key in options for key in ("rate", "max-in-flight")):
+            settings[name] = options
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Limit:
+    def __init__(self, options: dict):
+        rate = options.get("rate")
+        self.bucket = TokenBucket(rate, options.get("burst", max(rate, 1))) if rate else None
+        in_flight = options.get("max-in-flight")
+        self.semaphore = threading.BoundedSemaphore(in_flight) if in_flight else None
+
+
+def _get_limit(endpoint: str, key):
+    with _lock:
+        if (endpoint, key) not in _limits:
+            _limits[(endpoint, key)] = Limit(settings[endpoint])
+        return _limits[(endpoint, key)]
+
+
+@contextmanager
+def limit(endpoint: str, key=None, requests=1):
+    """
+    Waits for `requests` tokens of the endpoint's bucket and holds one of its in-flight slots
+    for the duration of the block. Endpoints without configured limits are not throttled.
+    """
+    if endpoint not in settings:
+        yield
+        return
+
+    endpoint_limit = _get_limit(endpoint, key)
+    if endpoint_limit.semaphore is not None:
+        endpoint_limit.semaphore.acquire()
+    try:
+        if endpoint_limit.bucket is not None:
+            for _ in range(requests):
+                endpoint_limit.bucket.acquire()
+        yield
+    finally:
+        if endpoint_limit.semaphore is not None:
+            endpoint_limit.semaphore.release()
@@ -0,0 +1,89 @@
+from gql.transport.exceptions import TransportError
+from networks.etherscan_client import EtherscanError
+from utils import metrics
+import aiohttp
+import asyncio
+import requests
+import time
+import websocket
+
+settings = {
+    # jobs processed at the same time
+    "concurrency": 8,
+    # attempts after the first one for jobs failing with network errors
+    "retries": 3,
+    # seconds before the first retry, doubled for every next one
+    "backoff": 5,
+}
+
+# Etherscan errors that depend on the request are handled where they are raised, the others are
+# rate limits and outages
+retryable_errors = (OSError, asyncio.TimeoutError, aiohttp.ClientError, requests.RequestException,
+                    websocket.WebSocketException, TransportError, EtherscanError)
+
+
+def configure(options: dict):
+    settings.update(options)
+
+
+class Job:
+    def __init__(self, name: str, fn, args: tuple):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.error = None
+        self.metrics = None
+
+
+class Scheduler:
+    """
+    Runs blocking jobs on worker threads from an asyncio loop: at most `concurrency` at a time,
+    retrying network failures with exponential backoff and printing progress as jobs finish.
+    Requests inside the jobs are throttled per endpoint by utils.ratelimit. With `profile`, the
+    metrics of every job are collected in job.metrics. With `quiet`, only failed jobs are printed.
+    """
+
+    def __init__(self, jobs: list, profile=False, quiet=False):
+        self.jobs = jobs
+        self.profile = profile
+        self.quiet = quiet
+        self.done = 0
+        self.semaphore = None
+
+    async def _run_job(self, job: Job):
+        async with self.semaphore:
+            # every task runs in its own context, copied to the threads of asyncio.to_thread
+            if self.profile:
+                job.metrics = metrics.begin(job.name)
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                try:
+                    await asyncio.to_thread(job.fn, *job.args)
+                    break
+                except retryable_errors as e:
+                    if attempt >= settings["retries"]:
+                        job.error = e
+                        break
+                    delay = settings["backoff"] * 2 ** attempt
+                    attempt += 1
+                    metrics.count("retries")
+                    print("WARN: {} failed: {!r}, retry {} in {}s".format(job.name, e, attempt, delay))
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    job.error = e
+                    break
+
+            if job.metrics is not None:
+                job.metrics.finish()
+            self.done += 1
+            if self.quiet and job.error is None:
+                return
+            status = "done" if job.error is None else "FAILED: {!r}".format(job.error)
+            print("[{}/{}] {} {} in {:.1f}s".format(self.done, len(self.jobs), job.name, status,
+                                                    time.monotonic() - start))
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(settings["concurrency"])
+        await asyncio.gather(*(self._run_job(job) for job in self.jobs))
+        return [job for job in self.jobs if job.error is not None]
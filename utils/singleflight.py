@@ -0,0 +1,37 @@
+import threading
+
+
+class SingleFlight:
+    """
+    De-duplicates concurrent fetches by key: a key is fetched by one thread at a time, other
+    threads asking for it wait for that fetch instead of issuing their own. Results are not
+    returned, fetch stores them where the callers look them up afterwards.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = dict()
+
+    def run(self, keys, fetch):
+        """
+        Calls fetch(keys) with the keys no other thread is fetching, then waits for the rest.
+        """
+        keys = list(dict.fromkeys(keys))
+        done = threading.Event()
+        with self.lock:
+            waits = {self.flights[key] for key in keys if key in self.flights}
+            claimed = [key for key in keys if key not in self.flights]
+            for key in claimed:
+                self.flights[key] = done
+
+        try:
+            if len(claimed) > 0:
+                fetch(claimed)
+        finally:
+            with self.lock:
+                for key in claimed:
+                    del self.flights[key]
+            done.set()
+
+        for flight in waits:
+            flight.wait()